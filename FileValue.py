@@ -0,0 +1,185 @@
+# defines FileValue, a lazy handle to the contents of a file
+# actions pass the handle around instead of the contents, so a file is only read when something needs the text
+# a handle stands for the contents the file had when it was made: files overwritten through write_to_file are first
+# copied aside for the handles to them, and a file changed any other way can no longer be read through its handles
+
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+
+
+class FileValue:
+    # every live handle, so that the handles to a file can be found before it is overwritten
+    __live_values = weakref.WeakSet()
+
+    def __init__(self, path, encoding="utf-8", block_size=1024 * 1024):
+        self.path = os.path.abspath(path)
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"No such file: '{path}'")
+        self.encoding = encoding
+        self.block_size = block_size
+        # set when the handle owns a private copy of the file, which is removed with the handle
+        self.temporary = False
+        self.signature = self.get_signature()
+        FileValue.__live_values.add(self)
+
+    def __str__(self):
+        return self.read_text()
+
+    def __repr__(self):
+        return f"FileValue({self.path!r})"
+
+    def __setstate__(self, state):
+        # copies (like those sent back from bulk workers) never own the private copy of the file
+        self.__dict__.update(state)
+        self.temporary = False
+        FileValue.__live_values.add(self)
+
+    def __del__(self):
+        if getattr(self, "temporary", False):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def get_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def check_unchanged(self):
+        """Raise if the file changed since the handle was made, rather than read contents it never stood for."""
+        if self.get_signature() != self.signature:
+            raise RuntimeError(f"'{self.path}' changed after it was read into a value")
+
+    def detach(self):
+        """Move the handle to a private copy of the file, so that it keeps its contents when the file changes."""
+        handle, copy_path = tempfile.mkstemp(prefix="promethia-", suffix="-" + os.path.basename(self.path))
+        os.close(handle)
+        self.copy_to(copy_path)
+        if self.temporary:
+            os.remove(self.path)
+        self.path = copy_path
+        self.temporary = True
+        self.signature = self.get_signature()
+
+    @staticmethod
+    def detach_handles_to(path):
+        """Detach every live handle to the file at path, before the file is overwritten."""
+        path = os.path.abspath(path)
+        for value in list(FileValue.__live_values):
+            if value.path == path:
+                try:
+                    value.detach()
+                except (OSError, RuntimeError):
+                    # the file already changed under the handle, which can not be read any more anyway
+                    pass
+
+    def size(self):
+        self.check_unchanged()
+        return self.signature[1]
+
+    def read_text(self):
+        """Read the whole file, only for consumers that really need the contents as one string."""
+        self.check_unchanged()
+        with open(self.path, 'r', encoding=self.encoding) as f:
+            return f.read()
+
+    def iter_blocks(self):
+        """Yield the raw contents of the file, one block at a time."""
+        self.check_unchanged()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b""):
+                yield block
+
+    def iter_text(self):
+        """Yield the decoded contents of the file, one block at a time."""
+        self.check_unchanged()
+        with open(self.path, 'r', encoding=self.encoding) as f:
+            for block in iter(lambda: f.read(self.block_size), ""):
+                yield block
+
+    def open_mmap(self):
+        """Map the file read-only into memory, the caller closes the map. Empty files can not be mapped."""
+        self.check_unchanged()
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def copy_to(self, path):
+        """Copy the file to path block by block, without reading it into memory."""
+        self.check_unchanged()
+        if os.path.exists(path) and os.path.samefile(self.path, path):
+            return
+        with open(self.path, 'rb') as source, open(path, 'wb') as destination:
+            shutil.copyfileobj(source, destination, self.block_size)
+
+    @staticmethod
+    def write_to_file(data, path, encoding="utf-8"):
+        """
+        Write data to path. File values are copied block by block, and iterators of str or bytes blocks are
+        written as they are produced, so neither is ever held in memory as a whole.
+        Handles to the file at path keep the contents it had before.
+        """
+        FileValue.detach_handles_to(path)
+        if isinstance(data, FileValue):
+            data.copy_to(path)
+            return
+
+        if isinstance(data, (str, bytes)):
+            blocks = iter([data])
+        elif hasattr(data, "__iter__") and not isinstance(data, (dict, list, tuple, set)):
+            blocks = iter(data)
+        else:
+            blocks = iter([str(data)])
+
+        first_block = next(blocks, "")
+        if isinstance(first_block, bytes):
+            with open(path, 'wb') as f:
+                f.write(first_block)
+                for block in blocks:
+                    f.write(block)
+        else:
+            with open(path, 'w', encoding=encoding) as f:
+                f.write(first_block)
+                for block in blocks:
+                    f.write(block)
+
+
+if __name__ == "__main__":
+    # Example usage of FileValue, copying a large file in constant memory
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "big.log")
+        FileValue.write_to_file((f"line {i} of a large log\n" for i in range(2_000_000)), source)
+
+        tracemalloc.start()
+        value = FileValue(source)
+        FileValue.write_to_file(value, os.path.join(directory, "copy.log"))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"Copied {value.size()} bytes with a peak of {peak} bytes allocated")
+        assert peak < value.size() // 4
+        with value.open_mmap() as mapped:
+            assert mapped[:6] == b"line 0"
+
+        # a handle keeps the contents it was made with when its file is overwritten
+        notes_path = os.path.join(directory, "notes.txt")
+        FileValue.write_to_file("original notes", notes_path)
+        backup = FileValue(notes_path)
+        FileValue.write_to_file("new text", notes_path)
+        FileValue.write_to_file(backup, os.path.join(directory, "backup.txt"))
+        assert FileValue(os.path.join(directory, "backup.txt")).read_text() == "original notes"
+        assert FileValue(notes_path).read_text() == "new text"
+
+        # a file changed behind the handle's back can not be read through it any more
+        notes = FileValue(notes_path)
+        with open(notes_path, 'a', encoding="utf-8") as f:
+            f.write(" and more")
+        try:
+            notes.read_text()
+            assert False, "read a changed file"
+        except RuntimeError:
+            pass
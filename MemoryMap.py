@@ -0,0 +1,198 @@
+# defines a singleton class MemoryMap
+# MemoryMap keeps the documents in the memory folder indexed for recall, and stays loaded across parses
+
+import logging
+import os
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+import faiss
+
+import TextUtils
+from Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryMap:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if MemoryMap.__instance is None:
+            MemoryMap()
+        return MemoryMap.__instance
+
+    def __init__(self, memory_path="./promethia-memory", page_size=256, overlap=64, max_stale_share=0.25):
+        if MemoryMap.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            MemoryMap.__instance = self
+            self.memory_path = memory_path
+            self.page_size = page_size
+            self.overlap = overlap
+            self.model = None
+            self.index = None
+            self.inverted_index = {"postings": {}, "page_lengths": []}
+            self.pages = []
+            self.page_sources = []
+            # document name -> (modification time, page ids), so changed documents can be re-ingested
+            self.documents = {}
+            # pages of documents that have since been replaced or deleted, they stay in the index but are never
+            # returned, until they make up more than max_stale_share of it and the index is rebuilt without them
+            self.stale_pages = set()
+            self.max_stale_share = max_stale_share
+            # page hash -> the first index row with that text, so repeated pages are never embedded twice
+            self.page_rows = {}
+
+    def set_embedding_model(self, model):
+        """Share an already loaded embedding model, so that the memory does not load its own."""
+        if self.model is None:
+            self.model = model
+
+    def get_embedding_model(self):
+        if self.model is None:
+            self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        return self.model
+
+    def refresh(self):
+        """
+        Ingest the documents in the memory folder that are new or have changed since they were last loaded, and
+        forget those that were deleted from it.
+        """
+        files = TextUtils.getIndexedFilesInDirectory(self.memory_path) if os.path.isdir(self.memory_path) else []
+        names = {os.path.basename(file) for file in files}
+        for name in [name for name in self.documents if name not in names]:
+            self.stale_pages.update(self.documents.pop(name)[1])
+
+        for file in files:
+            name = os.path.basename(file)
+            modified = os.path.getmtime(file)
+            if name in self.documents and self.documents[name][0] == modified:
+                continue
+
+            try:
+                text = self.read_document(file)
+            except Exception as e:
+                logger.error("Error loading memory %s: %s", name, e)
+                # remember the failure so the document is not retried until it changes
+                self.documents[name] = (modified, [])
+                continue
+            self.add_document(name, text, modified)
+        self.reclaim_stale_pages()
+
+    @staticmethod
+    def read_document(file_path):
+        if file_path.lower().endswith(".pdf"):
+            return TextUtils.pdfToText(file_path)
+        with open(file_path, 'r', encoding="utf-8") as f:
+            return f.read()
+
+    def add_document(self, name, text, modified=None):
+        """Add a document to the index, replacing any earlier version of the document with the same name."""
+        if name in self.documents:
+            self.stale_pages.update(self.documents[name][1])
+
+        # pages are cut between lines, so boilerplate comes out as the same pages, and a page that is already in the
+        # index is not embedded again
+        pages = TextUtils.getListOfChunks(text, self.page_size, self.overlap)
+
+        first_page = len(self.pages)
+        if len(pages) > 0:
+            page_hashes = [TextUtils.getChunkHash(page) for page in pages]
+            # pages already in the index (from other documents or an earlier version of this one) are reused
+            known_embeddings = {page_hash: self.index.reconstruct(self.page_rows[page_hash])
+                                for page_hash in page_hashes if page_hash in self.page_rows}
+            metrics = Metrics.get_instance()
+            with metrics.timer("memory.encode"):
+                embeddings, stats = TextUtils.convertChunksToEmbeddings(pages, self.get_embedding_model(),
+                                                                        known_embeddings)
+            if stats["embedded_chunks"] > 0:
+                metrics.increment("memory.embedding_calls")
+            TextUtils.logChunkStats(name, stats)
+            if self.index is None:
+                self.index = faiss.IndexFlatL2(embeddings.shape[1])
+            self.index.add(embeddings)
+            TextUtils.addPagesToInvertedIndex(self.inverted_index, pages)
+            self.pages += pages
+            self.page_sources += [(name, page_number) for page_number in range(len(pages))]
+            for row, page_hash in enumerate(page_hashes, first_page):
+                self.page_rows.setdefault(page_hash, row)
+
+        self.documents[name] = (modified, list(range(first_page, len(self.pages))))
+        self.reclaim_stale_pages()
+
+    def reclaim_stale_pages(self):
+        """
+        Rebuild the index from the pages of the current documents, once stale pages make up more than
+        max_stale_share of it. The embeddings are taken from the old index, so nothing is embedded again.
+        """
+        if not self.stale_pages or len(self.stale_pages) <= self.max_stale_share * len(self.pages):
+            return
+        logger.debug("Reclaiming %d stale pages of %d", len(self.stale_pages), len(self.pages))
+
+        rows = [row for _, page_ids in self.documents.values() for row in page_ids]
+        if rows:
+            embeddings = self.index.reconstruct_n(0, self.index.ntotal)[np.array(rows, dtype=np.int64)]
+            self.index = faiss.IndexFlatL2(self.index.d)
+            self.index.add(embeddings)
+        else:
+            self.index = None
+        self.pages = [self.pages[row] for row in rows]
+        self.page_sources = [self.page_sources[row] for row in rows]
+        self.inverted_index = TextUtils.addPagesToInvertedIndex({"postings": {}, "page_lengths": []}, self.pages)
+        self.page_rows = {}
+        for row, page in enumerate(self.pages):
+            self.page_rows.setdefault(TextUtils.getChunkHash(page), row)
+
+        first_page = 0
+        for name, (modified, page_ids) in self.documents.items():
+            self.documents[name] = (modified, list(range(first_page, first_page + len(page_ids))))
+            first_page += len(page_ids)
+        self.stale_pages = set()
+
+    def remember(self, name, data):
+        """Save data to the memory folder under the given name and add it to the index."""
+        name = os.path.basename(name)
+        if not os.path.splitext(name)[1]:
+            name += ".txt"
+
+        os.makedirs(self.memory_path, exist_ok=True)
+        file_path = os.path.join(self.memory_path, name)
+        with open(file_path, 'w', encoding="utf-8") as f:
+            f.write(data)
+
+        self.add_document(name, data, os.path.getmtime(file_path))
+
+    def recall(self, query, k=3):
+        """Return the k pages of memory that best match the query, as (document name, page text) pairs."""
+        with Metrics.get_instance().timer("memory.refresh"):
+            self.refresh()
+        if self.index is None:
+            return []
+
+        hits = TextUtils.getHybridSimilarPagesForQueries(self.index, self.inverted_index, [query],
+                                                         self.get_embedding_model(), k=k + len(self.stale_pages),
+                                                         page_sources=self.page_sources)[0]
+        hits = [hit for hit in hits if hit["page"] not in self.stale_pages][:k]
+        return [(hit["source"][0], self.pages[hit["page"]]) for hit in hits]
+
+
+if __name__ == "__main__":
+    # Example usage of the MemoryMap
+    memory = MemoryMap.get_instance()
+    memory.remember("puffins", "Puffins are seabirds that nest in burrows on cliffs and eat small fish.")
+    print(memory.recall("what do puffins eat?"))
+    print(memory.recall("attention heads in the transformer"))
+
+    # remembering a note again replaces it, and the old versions are dropped from the index once they pile up
+    for version in range(5):
+        memory.remember("puffin count", f"{version} puffins were counted on the cliffs today.")
+    assert len(memory.stale_pages) <= memory.max_stale_share * len(memory.pages)
+    hits = memory.recall("how many puffins were counted?", k=10)
+    assert [page for name, page in hits if name == "puffin count.txt"] == ["4 puffins were counted on the cliffs today."]
+
+    # a document deleted from the memory folder is forgotten
+    os.remove(os.path.join(memory.memory_path, "puffin count.txt"))
+    os.remove(os.path.join(memory.memory_path, "puffins.txt"))
+    assert all(name not in ("puffins.txt", "puffin count.txt") for name, _ in memory.recall("puffins", k=10))
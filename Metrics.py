@@ -0,0 +1,128 @@
+# defines a singleton class Metrics
+# Metrics collects per-stage latencies and counters from the parse pipeline, and does nothing until it is enabled
+
+import bisect
+import os
+import threading
+import time
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket takes everything slower
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Metrics:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if Metrics.__instance is None:
+            Metrics()
+        return Metrics.__instance
+
+    def __init__(self):
+        if Metrics.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            Metrics.__instance = self
+            self.enabled = os.environ.get("PROMETHIA_METRICS", "") == "1"
+            self.lock = threading.Lock()
+            # hooks are called as hook(kind, name, value), kind being "latency" or "count"
+            self.hooks = []
+            self.histograms = {}
+            self.counters = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def timer(self, stage):
+        """Return a context manager that records the time spent in its block under stage."""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+                self.histograms[stage] = histogram
+            histogram["count"] += 1
+            histogram["total"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        for hook in self.hooks:
+            hook("latency", stage, seconds)
+
+    def increment(self, counter, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+        for hook in self.hooks:
+            hook("count", counter, amount)
+
+    def get_total(self, stage):
+        """Return the total time recorded under stage so far."""
+        histogram = self.histograms.get(stage)
+        return histogram["total"] if histogram is not None else 0.0
+
+    def snapshot(self):
+        """Return a copy of the collected metrics, with the mean latency of every stage."""
+        with self.lock:
+            latencies = {}
+            for stage, histogram in self.histograms.items():
+                latencies[stage] = dict(histogram, buckets=list(histogram["buckets"]),
+                                        mean=histogram["total"] / histogram["count"])
+            return {"latency": latencies, "counters": dict(self.counters), "buckets": list(LATENCY_BUCKETS)}
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# shared by every disabled timer, so timing a disabled stage allocates nothing
+NULL_TIMER = _NullTimer()
+
+
+if __name__ == "__main__":
+    # Example usage of the Metrics
+    metrics = Metrics.get_instance()
+    metrics.enable()
+    metrics.add_hook(lambda kind, name, value: print(f"{kind} {name} {value}"))
+    for _ in range(3):
+        with metrics.timer("example.sleep"):
+            time.sleep(0.001)
+        metrics.increment("example.calls")
+    print(metrics.snapshot())
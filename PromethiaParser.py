@@ -1,16 +1,30 @@
+import logging
+import multiprocessing
+import os
+import pickle
 import re
+import threading
+import time
+from collections import Counter
 from inspect import signature, getmembers, isfunction
 import importlib.util
-import os
 from itertools import product
 from TokenMap import TokenMap
 from SemanticMapper import SemanticMapper
 from VariableMap import VariableMap
+from MemoryMap import MemoryMap
+from WordResolver import WordResolver
+from Metrics import Metrics
+import TextUtils
+
+logger = logging.getLogger(__name__)
 
 class Node:
     def __init__(self, token_id, next_nodes=None, action=None):
         self.token_id = token_id
         self.next_nodes = next_nodes or []
+        # token id -> next node, so that a step through the trie is a single lookup
+        self.transitions = {next_node.token_id: next_node for next_node in self.next_nodes}
         self.action = action
 
 
@@ -21,44 +35,96 @@ class FunctionMap:
     def assign_function_reference_to_signature(self, token_signature, function_reference, parameters, docstring):
         current_node = self.root
         for token_id in token_signature:
-            match_found = False
-            for next_node in current_node.next_nodes:
-                if token_id == next_node.token_id:
-                    current_node = next_node
-                    match_found = True
-                    break
-            if not match_found:
-                new_node = Node(token_id)
-                current_node.next_nodes.append(new_node)
-                current_node = new_node
+            next_node = current_node.transitions.get(token_id)
+            if next_node is None:
+                next_node = Node(token_id)
+                current_node.next_nodes.append(next_node)
+                current_node.transitions[token_id] = next_node
+            current_node = next_node
         current_node.action = (function_reference, parameters, docstring)
 
+    def remove_function_reference_from_signature(self, token_signature, function_reference):
+        nodes = [self.root]
+        for token_id in token_signature:
+            next_node = nodes[-1].transitions.get(token_id)
+            if next_node is None:
+                return
+            nodes.append(next_node)
+
+        # the signature may have been taken over by a newer action since, which then stays
+        if nodes[-1].action is None or nodes[-1].action[0] is not function_reference:
+            return
+        nodes[-1].action = None
+
+        # prune the nodes that no longer lead to any action
+        while len(nodes) > 1 and nodes[-1].action is None and not nodes[-1].next_nodes:
+            node = nodes.pop()
+            nodes[-1].next_nodes.remove(node)
+            del nodes[-1].transitions[node.token_id]
+
     def get_next_node(self, current_node, token_id):
-        for next_node in current_node.next_nodes:
-            if token_id == next_node.token_id:
-                return next_node
-        return None
+        return current_node.transitions.get(token_id)
 
 
 class PromethiaParser:
-    def __init__(self, action_path="./promethia-actions", synonyms_file="promethia-actions/synonyms.json"):
+    def __init__(self, action_path="./promethia-actions", synonyms_file="promethia-actions/synonyms.json",
+                 embedding_model=None, shared_semantic_prefix=None):
         self.function_map = FunctionMap()
         self.action_path = action_path
         self.token_map = TokenMap(synonyms_file)
+        # resolves exact, case folded and misspelled tokens before falling back to the semantic mapper
+        self.word_resolver = WordResolver()
+        # created once the first actions are loaded, so that their vocabulary is embedded in one batch
+        self.semantic_mapper = None
+        # action -> (token signatures, tokens) it was registered with, so that it can be unregistered
+        self.registrations = {}
+        # token -> number of registered actions that use it, a token's vocabulary goes with the last of them
+        self.token_counts = Counter()
+        # action file name -> (hash of its contents, the actions registered from it)
+        self.action_files = {}
+        # set by the action watcher, the next parse then reloads the actions first
+        self.reload_pending = False
+        self.stop_watching = None
 
         self.load_actions_from_files()
-        # Create a semantic mapper
-        self.semantic_mapper = SemanticMapper(self.token_map.string_to_synonyms_map)
+        if shared_semantic_prefix is not None:
+            # the vocabulary was embedded by a parser in another process (see share_semantic_mapper) from the same
+            # action files, so its index is mapped rather than built again
+            self.semantic_mapper = SemanticMapper.load_shared(shared_semantic_prefix, embedding_model=embedding_model)
+        else:
+            # Create a semantic mapper, with its own copy of the vocabulary which is kept in step as actions come and go
+            self.semantic_mapper = SemanticMapper(dict(self.token_map.string_to_synonyms_map),
+                                                  embedding_model=embedding_model)
+        # the memory actions embed with the same model, so share it rather than loading a second copy
+        MemoryMap.get_instance().set_embedding_model(self.semantic_mapper.model)
+        # the whole words the model knows are real words, and never taken for typos of a token
+        self.word_resolver.add_known_words(self.get_dictionary_words(self.semantic_mapper.model))
         self.last_result = None
+        # the (action name, arguments) of every action the last parse ran
+        self.last_calls = []
+        # when set, actions are only compiled into last_calls and never run
+        self.dry_run = False
+
+    @staticmethod
+    def get_dictionary_words(model):
+        tokenizer = getattr(model, "tokenizer", None)
+        if tokenizer is None or not hasattr(tokenizer, "get_vocab"):
+            return []
+        # word piece vocabularies mark the pieces of longer words with ##, those are not words of their own
+        return [word for word in tokenizer.get_vocab() if word.isalpha()]
 
     def register_action(self, func):
+        """Add an action to the parser, returning False if it has no docstring to take its signature from."""
         params = list(signature(func).parameters.keys())
 
         if not func.__doc__:
-            print(f"Warning: {func.__name__} has no docstring. It will not be loaded as an action.")
-            return
+            logger.warning("%s has no docstring. It will not be loaded as an action.", func.__name__)
+            return False
+
+        if func in self.registrations:
+            self.unregister_action(func)
 
-        print(f"Registering action: {func.__name__}")
+        logger.debug("Registering action: %s", func.__name__)
         description = func.__doc__.strip()
 
         # Tokenize the function signature
@@ -67,12 +133,53 @@ class PromethiaParser:
         words = [word.strip('()') for word in words]
         words = ['__param__' if '<' in word and '>' in word else word for word in words]
         token_ids = [self.token_map.add_or_get_token_id(word) for word in words]
+        # special tokens (like parameters) are never resolved from words
+        tokens = {self.token_map.get_token_by_id(token_id) for token_id in token_ids if token_id >= 0}
+        for token in tokens:
+            self.add_token_vocabulary(token)
 
         # Generate token signature tuples
         token_signature_tuples = self.generate_token_signature_tuples(token_ids, optional_map)
         for token_signature in token_signature_tuples:
             self.function_map.assign_function_reference_to_signature(token_signature, func, params, description)
 
+        self.registrations[func] = (token_signature_tuples, tokens)
+        return True
+
+    def unregister_action(self, func):
+        """Remove an action from the parser, along with the vocabulary that no other action uses."""
+        registration = self.registrations.pop(func, None)
+        if registration is None:
+            return
+        logger.debug("Unregistering action: %s", func.__name__)
+
+        token_signature_tuples, tokens = registration
+        for token_signature in token_signature_tuples:
+            self.function_map.remove_function_reference_from_signature(token_signature, func)
+        for token in tokens:
+            self.remove_token_vocabulary(token)
+
+    def add_token_vocabulary(self, token):
+        self.token_counts[token] += 1
+        if self.token_counts[token] > 1:
+            return
+        descriptions = self.token_map.string_to_synonyms_map[token]
+        self.word_resolver.add_descriptions(token, descriptions)
+        if self.semantic_mapper is not None and token not in self.semantic_mapper.id_to_descriptions:
+            self.semantic_mapper.add_id_and_descriptions(token, list(descriptions))
+
+    def remove_token_vocabulary(self, token):
+        self.token_counts[token] -= 1
+        if self.token_counts[token] > 0:
+            return
+        del self.token_counts[token]
+        # the token keeps its id in the token map, so ids in use never change
+        self.word_resolver.remove_descriptions(token)
+        # actions registered again while the first ones load (like an action imported into two files) come
+        # before the semantic mapper, which is then built from the token map alone
+        if self.semantic_mapper is not None and token in self.semantic_mapper.id_to_descriptions:
+            self.semantic_mapper.remove_id(token)
+
     @staticmethod
     def generate_token_signature_tuples(token_ids, optional_map):
         assert len(token_ids) == len(optional_map), "token_ids and optional_map must be of the same length."
@@ -90,28 +197,114 @@ class PromethiaParser:
 
         return token_signature_tuples
 
+    def get_action_filenames(self):
+        return [filename for filename in os.listdir(self.action_path)
+                if filename.endswith(".py") and filename != "__init__.py"]
+
     def load_actions_from_files(self, action_filenames=None):
         if action_filenames is None:
-            action_filenames = [filename for filename in os.listdir(self.action_path)
-                                if filename.endswith(".py") and filename != "__init__.py"]
+            action_filenames = self.get_action_filenames()
 
         for action_filename in action_filenames:
             self.load_actions_from_file(action_filename)
 
     def load_actions_from_file(self, action_filename):
+        """Register the actions of an action file, returning them, or None if the file failed to load."""
         module_name = os.path.splitext(os.path.basename(action_filename))[0]
+        action_file = self.action_path + "/" + action_filename
+        file_hash = TextUtils.calculateHashForFile(action_file)
 
         try:
-            spec = importlib.util.spec_from_file_location(module_name, self.action_path + "/" + action_filename)
+            spec = importlib.util.spec_from_file_location(module_name, action_file)
             module = importlib.util.module_from_spec(spec)
             spec.loader.exec_module(module)
         except Exception as e:
-            print(f"Error loading module {module_name}: {e}")
-            return
+            logger.error("Error loading module %s: %s", module_name, e)
+            # the actions of the version that last loaded stay registered until the file is fixed
+            loaded = self.action_files.get(action_filename)
+            self.action_files[action_filename] = (file_hash, loaded[1] if loaded is not None else [])
+            return None
 
+        actions = []
         for name, obj in getmembers(module):
-            if isfunction(obj):
-                self.register_action(obj)
+            if isfunction(obj) and self.register_action(obj):
+                actions.append(obj)
+        self.action_files[action_filename] = (file_hash, actions)
+        return actions
+
+    def get_changed_action_files(self):
+        """Return the names of the action files that were added, changed or deleted since they were last loaded."""
+        action_filenames = self.get_action_filenames()
+        changed = []
+        for action_filename in action_filenames:
+            loaded = self.action_files.get(action_filename)
+            try:
+                if loaded is None or loaded[0] != TextUtils.calculateHashForFile(self.action_path + "/" + action_filename):
+                    changed.append(action_filename)
+            except OSError:
+                # deleted since it was listed, it is picked up as deleted on the next check
+                pass
+        changed += [action_filename for action_filename in list(self.action_files)
+                    if action_filename not in action_filenames]
+        return changed
+
+    def share_semantic_mapper(self, prefix=None):
+        """
+        Write the vocabulary index to files that parsers in other processes map with shared_semantic_prefix, and
+        map it in this parser too, so that every parser on the host shares one copy. Returns the prefix of the
+        files.
+        Actions registered later give the parser that registers them a private index again.
+        """
+        prefix = self.semantic_mapper.save_shared(prefix)
+        self.semantic_mapper = SemanticMapper.load_shared(prefix, embedding_model=self.semantic_mapper.model)
+        return prefix
+
+    def reload_actions(self):
+        """
+        Bring the actions up to date with the action files, without building a new parser. Only the actions of
+        added, changed and deleted files are registered or unregistered, and only the vocabulary they add or no
+        longer share with other actions is embedded or dropped. Returns the names of the files that changed.
+        """
+        self.reload_pending = False
+        changed = self.get_changed_action_files()
+        for action_filename in changed:
+            loaded = self.action_files.get(action_filename)
+            if os.path.exists(self.action_path + "/" + action_filename):
+                # the new version goes in before the old one is taken out, so shared vocabulary is never re-embedded
+                actions = self.load_actions_from_file(action_filename)
+                if actions is None:
+                    continue
+            else:
+                actions = []
+                del self.action_files[action_filename]
+            if loaded is not None:
+                for func in loaded[1]:
+                    if func not in actions:
+                        self.unregister_action(func)
+
+        if changed:
+            logger.info("Reloaded action files: %s", ", ".join(changed))
+        return changed
+
+    def watch_actions(self, interval=1.0):
+        """
+        Check the action files for changes every interval seconds, in a background thread. Changes are reloaded
+        at the start of the next parse, so a parse never runs against half reloaded actions.
+        """
+        if self.stop_watching is not None:
+            return
+        self.stop_watching = threading.Event()
+        threading.Thread(target=self.watch_action_files, args=(interval, self.stop_watching), daemon=True).start()
+
+    def watch_action_files(self, interval, stop_watching):
+        while not stop_watching.wait(interval):
+            if not self.reload_pending and self.get_changed_action_files():
+                self.reload_pending = True
+
+    def stop_watching_actions(self):
+        if self.stop_watching is not None:
+            self.stop_watching.set()
+            self.stop_watching = None
 
     @staticmethod
     def split_words_and_string_literals(input_string):
@@ -121,146 +314,152 @@ class PromethiaParser:
         return matches
 
     def parse_string(self, input_string, verbose=False):
-        words = self.split_words_and_string_literals(input_string)
-        current_node = self.function_map.root
-
-        reading_param = False
+        if self.reload_pending:
+            self.reload_actions()
+
+        metrics = Metrics.get_instance()
+        # read once, so that metrics enabled by another thread mid-parse are only recorded from the next parse
+        metrics_enabled = metrics.enabled
+        if metrics_enabled:
+            parse_start = time.perf_counter()
+            nested_before = metrics.get_total("parser.resolve") + metrics.get_total("parser.actions")
+
+        self.last_calls = []
+        with metrics.timer("parser.tokenize"):
+            words = self.split_words_and_string_literals(input_string)
+        # every word is resolved once, up front, and the parse below only indexes into the result
+        with metrics.timer("parser.resolve"):
+            # the positions of words that were only resolved as a typo of a token
+            typo_positions = set()
+            token_ids = self.resolve_words(words, typo_positions)
+        plain_words = [self.is_plain_word(word) for word in words]
+
+        root = self.function_map.root
+        variable_map = VariableMap.get_instance()
+
+        def token_at(index, param_node=None):
+            # actions can create variables mid-line, so whether a word is a variable is checked when it is reached
+            if plain_words[index] and variable_map.is_variable(words[index]):
+                return -2
+            if token_ids[index] is None:
+                word_typo_positions = set()
+                with metrics.timer("parser.resolve"):
+                    token_ids[index] = self.resolve_words([words[index]], word_typo_positions)[0]
+                if word_typo_positions:
+                    typo_positions.add(index)
+            # inside a param, a typo only counts as the token the action expects next, so ordinary words that are
+            # close to a token ("kind" to "find") never cut the param short
+            if (param_node is not None and index in typo_positions
+                    and token_ids[index] not in param_node.transitions):
+                return -1
+            return token_ids[index]
+
+        num_words = len(words)
+        i = 0
+        current_node = root
         param_index = 0
         param_map = {}
 
         if verbose:
             print(f"Parsing string: {input_string}")
 
-        while words:
+        while i < num_words:
             bypass_param = False
-            word = words.pop(0)
-            token_id = self.token_from_word(word)
+            word = words[i]
+            token_id = token_at(i)
+            i += 1
 
             if verbose:
                 print(f"Current word: {word} ({token_id})")
 
             if token_id == -4:
-                # a stop token only counts as a stop token if it is followed by noting or a valid next start of a sequence
-                peek_node = self.function_map.get_next_node(self.function_map.root, self.token_from_word(words[0]))
-                if not words or peek_node is not None:
-                    # if we have a stop token, we can stop parsing
+                # a stop token only counts as a stop token if it is followed by nothing or a valid next start of a sequence
+                if i == num_words or token_at(i) in root.transitions:
                     self.execute_function(current_node, param_map, verbose=verbose)
                     param_map = {}
-                    current_node = self.function_map.root
+                    current_node = root
                     param_index = 0
-                else:
-                    token_id = -1
+                    continue
+                token_id = -1
 
             if token_id == -2:
-                #a variable is always a param, an entire param
-                value = VariableMap.get_instance().get_data(word)
-                param_map[param_index] = [value]
+                # a variable is always a param, an entire param
+                param_map[param_index] = [variable_map.get_data(word)]
                 param_index += 1
                 bypass_param = True
                 token_id = -1
 
-            if token_id == -2:
-                #a variable is always a param, an entire param
-                value = VariableMap.get_instance().get_data(word)
-                param_map[param_index] = [value]
-                param_index += 1
-                next_node = self.function_map.get_next_node(current_node, -1)
-                if next_node is not None:
-                    current_node = next_node
+            if token_id == -3:
+                # a null token is only kept if it would work as a param, otherwise it is skipped
+                if -1 in current_node.transitions:
+                    token_id = -1
+                else:
+                    continue
+
+            next_node = current_node.transitions.get(token_id)
+            if next_node is None:
+                current_node = root
+                continue
+            current_node = next_node
+
+            if current_node.token_id != -1 or bypass_param:
+                continue
+
+            # the first word is always part of the param, the param then runs until a stop token,
+            # the start of another action or the next token of this action
+            param_map[param_index] = [word]
+            while True:
+                if i == num_words:
+                    # if the string ends while reading a param then we are done
                     self.execute_function(current_node, param_map, verbose=verbose)
                     param_map = {}
-                    current_node = self.function_map.root
+                    current_node = root
                     param_index = 0
-                else:
-                    current_node = self.function_map.root
-                continue
+                    break
 
-            if token_id == -3:
-                # check to see if this would work as a param
-                if not reading_param:
-                    if self.function_map.get_next_node(current_node, -1) is not None:
-                        token_id = -1
-                    else:
-                        # if we're not reading a param, we can skip the null token
-                        continue
-
-            if current_node is not None:
-                next_node = self.function_map.get_next_node(current_node, token_id)
-                if next_node is not None:
-                    current_node = next_node
+                word = words[i]
+                token_id = token_at(i, current_node)
+                i += 1
+
+                if verbose:
+                    print(f"In Parameter Parse - Current word: {word} ({token_id})")
+
+                if token_id == -4:
+                    # after a stop token the start of a new action is expected, so a typo of one counts here
+                    if i == num_words or token_at(i) in root.transitions:
+                        self.execute_function(current_node, param_map, verbose=verbose)
+                        param_map = {}
+                        current_node = root
+                        param_index = 0
+                        break
+                    param_map[param_index].append(word)
+                elif token_id == -1:
+                    param_map[param_index].append(word)
+                elif token_id in root.transitions:
+                    # leave the word where it is, so it starts the next action
+                    i -= 1
+                    self.execute_function(current_node, param_map, verbose=verbose)
+                    param_map = {}
+                    current_node = root
+                    param_index = 0
+                    break
                 else:
-                    current_node = self.function_map.root
-                    continue
+                    next_node = current_node.transitions.get(token_id)
+                    if next_node is not None:
+                        current_node = next_node
+                        param_index += 1
+                        break
+                    param_map[param_index].append(word)
 
-            if current_node is not None:
-                if current_node.token_id == -1 and bypass_param is False:
-                    if not reading_param:
-                        param_map[param_index] = []
-                        reading_param = True
-                        # the first one's always a param
-                        param_map[param_index].append(word)
-                    while reading_param:
-                        if words:
-                            word = words.pop(0)
-                            token_id = self.token_from_word(word)
-
-                            if verbose:
-                                print(f"In Parameter Parse - Current word: {word} ({token_id})")
-
-                            # there are 3 possible cases here:
-                            # 1. the word is an unknown token (token_id == -1)
-                            # 2. the word is a known token, but it would not lead to a valid next node
-                            # 3. the word is a known token, and it would lead to a valid next node
-                            # in case 1, we add the word to the current param_map
-
-                            if token_id == -4:
-                                peek_node = self.function_map.get_next_node(self.function_map.root,
-                                                                            self.token_from_word(words[0]))
-                                if not words or peek_node is not None:
-                                    # if we have a stop token, we can stop parsing
-                                    reading_param = False
-                                    self.execute_function(current_node, param_map, verbose=verbose)
-                                    param_map = {}
-                                    current_node = self.function_map.root
-                                    param_index = 0
-                                    break
-                                else:
-                                    param_map[param_index].append(word)
-                                    continue
-
-                            if token_id == -1:
-                                param_map[param_index].append(word)
-                            elif self.function_map.get_next_node(self.function_map.root, token_id) is not None:
-                                reading_param = False
-                                # push the word back into the stack
-                                words.insert(0, word)
-                                self.execute_function(current_node, param_map, verbose=verbose)
-                                param_map = {}
-                                current_node = self.function_map.root
-                                param_index = 0
-                            else:
-                                next_node = self.function_map.get_next_node(current_node, token_id)
-                                if next_node is not None:
-                                    current_node = next_node
-                                    reading_param = False
-                                    param_index += 1
-                                else:
-                                    param_map[param_index].append(word)
-                        else:
-                            reading_param = False
-                            # if the string ends while reading a param then we are done
-                            self.execute_function(current_node, param_map, verbose=verbose)
-                            param_map = {}
-                            current_node = self.function_map.root
-                            param_index = 0
-                            break
-                elif token_id == -3: # if not a param and we have a null token, we can skip it
-                    # if we have a null token, we can skip it
-                    continue
-        else:
-            if current_node is not None:
-                if current_node.action is not None:
-                    self.execute_function(current_node, param_map)
+        if current_node.action is not None:
+            self.execute_function(current_node, param_map)
+
+        if metrics_enabled:
+            elapsed = time.perf_counter() - parse_start
+            nested = metrics.get_total("parser.resolve") + metrics.get_total("parser.actions") - nested_before
+            metrics.record("parser.parse_string", elapsed)
+            # what is left once word resolution and the actions are taken out is the trie walk itself
+            metrics.record("parser.walk", elapsed - nested)
 
     def execute_function(self, current_node, param_map, verbose=False):
         if current_node is None:
@@ -274,16 +473,37 @@ class PromethiaParser:
 
             # go through the param_map and turn it into a list of arguments, joining the words
             for param_index in range(len(param_map)):
-                parsed_args.append(" ".join(param_map[param_index]))
+                param = param_map[param_index]
+                if len(param) == 1 and not isinstance(param[0], str):
+                    # values from variables (like file handles) are passed on as they are, without copying them
+                    parsed_args.append(param[0])
+                else:
+                    parsed_args.append(" ".join(param))
 
             # if any of the args are wrapped in quotes, remove them (but only if they are the first and last characters)
             for i in range(len(parsed_args)):
+                if not isinstance(parsed_args[i], str) or len(parsed_args[i]) < 2:
+                    continue
                 if parsed_args[i][0] == '"' and parsed_args[i][-1] == '"':
                     parsed_args[i] = parsed_args[i][1:-1]
                 if parsed_args[i][0] == "'" and parsed_args[i][-1] == "'":
                     parsed_args[i] = parsed_args[i][1:-1]
 
-            self.last_result = func_ref(*parsed_args)
+            self.last_calls.append((func_ref.__name__, parsed_args))
+            if self.dry_run:
+                if verbose:
+                    print(f"Compiled function {func_ref.__name__} with params {parsed_args}")
+                return
+
+            metrics = Metrics.get_instance()
+            if metrics.enabled:
+                action_start = time.perf_counter()
+                self.last_result = func_ref(*parsed_args)
+                action_time = time.perf_counter() - action_start
+                metrics.record("parser.actions", action_time)
+                metrics.record(f"action.{func_ref.__name__}", action_time)
+            else:
+                self.last_result = func_ref(*parsed_args)
             # save last result to a variable named 'it'
             VariableMap.get_instance().set_data("it", self.last_result)
 
@@ -295,21 +515,127 @@ class PromethiaParser:
                 print("No action found for this node")
 
 
-    def token_from_word(self, word):
-        # only parse a word if it is not a string literal
-        if word[0] == '"' or word[0] == "'":
-            return -1
+    def parse_lines(self, lines, workers=None, chunk_size=64, dry_run=False):
+        """
+        Parse many lines, yielding a (calls, result) pair for each line in order, where calls lists the
+        (action name, arguments) of the actions the line ran and result is the parser's last result after it
+        (or the exception, if an action raised one). Arguments and results that can not be pickled are given as
+        their repr.
+
+        With more than one worker the lines are sharded over a pool of forked processes, which inherit this
+        parser already loaded (model, semantic index and trie are shared copy-on-write, nothing is reloaded).
+        Variables set by one line are then only seen by later lines handled by the same worker.
+        With dry_run the lines are only compiled into calls and no action is run.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            was_dry_run = self.dry_run
+            self.dry_run = dry_run
+            try:
+                for line in lines:
+                    yield parse_line_for_bulk(self, line)
+            finally:
+                self.dry_run = was_dry_run
+            return
+
+        global bulk_parser
+        bulk_parser = self
+        # the tokenizers of the embedding model must not start their own threads in the forked workers
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=init_bulk_worker, initargs=(dry_run,)) as pool:
+            yield from pool.imap(parse_line_in_bulk_worker, lines, chunksize=chunk_size)
 
-        # also dont try to parse something without alpha characters in it
-        if not any(c.isalpha() for c in word):
-            return -1
+    @staticmethod
+    def is_plain_word(word):
+        # string literals and words without alpha characters are always params, never tokens or variables
+        return word[0] != '"' and word[0] != "'" and any(c.isalpha() for c in word)
 
-        if VariableMap.get_instance().is_variable(word):
+    def token_from_word(self, word):
+        if self.is_plain_word(word) and VariableMap.get_instance().is_variable(word):
             return -2
+        with Metrics.get_instance().timer("parser.resolve"):
+            return self.resolve_words([word])[0]
+
+    def resolve_words(self, words, typo_positions=None):
+        """
+        Return the token id of each word. Words that are currently variables get None, since what they resolve
+        to only matters if they stop being one. Words that need the embedding search are looked up in one batch.
+        The positions of words that were resolved as typos of a token are added to typo_positions, if given.
+        """
+        token_ids = [None] * len(words)
+        pending = {}
+        variable_map = VariableMap.get_instance()
+
+        for i, word in enumerate(words):
+            if not self.is_plain_word(word):
+                token_ids[i] = -1
+                continue
+            if variable_map.is_variable(word):
+                continue
+
+            parsed_word = self.semantic_mapper.filter_special_word(word)
+            if parsed_word is not None:
+                self.word_resolver.count_hit("special")
+            else:
+                parsed_word, tier = self.word_resolver.resolve_with_tier(word)
+                if tier == "fuzzy" and typo_positions is not None:
+                    typo_positions.add(i)
+            if parsed_word is None:
+                pending.setdefault(word, []).append(i)
+                continue
+            token_ids[i] = self.token_map.token_to_id.get(parsed_word, -1)
+
+        if pending:
+            pending_words = list(pending)
+            for word, parsed_word in zip(pending_words, self.semantic_mapper.parse_words(pending_words)):
+                self.word_resolver.count_hit("embedding")
+                for i in pending[word]:
+                    token_ids[i] = self.token_map.token_to_id.get(parsed_word, -1)
+
+        return token_ids
+
+
+# the parser the bulk workers inherit when they are forked
+bulk_parser = None
+
+
+def init_bulk_worker(dry_run):
+    bulk_parser.dry_run = dry_run
+    try:
+        # one core per worker, the pool already uses them all
+        import faiss
+        faiss.omp_set_num_threads(1)
+    except (ImportError, AttributeError):
+        pass
+
+
+def parse_line_in_bulk_worker(line):
+    return parse_line_for_bulk(bulk_parser, line)
 
-        parsed_word = self.semantic_mapper.parse_word(word)
-        token_id = self.token_map.token_to_id.get(parsed_word, -1)
-        return token_id
+
+def get_picklable(value):
+    # calls and results have to travel back from the workers, so values that can not are sent as their repr
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:
+        return repr(value)
+
+
+def parse_line_for_bulk(parser, line):
+    parser.last_result = None
+    try:
+        parser.parse_string(line)
+        result = parser.last_result
+    except Exception as e:
+        # one failing line should not end the whole run, so the error is returned in place of the result
+        result = e
+    # the arguments of the calls can be values from variables (like locks or open files) just as well
+    calls = [(name, [get_picklable(arg) for arg in args]) for name, args in parser.last_calls]
+    return calls, get_picklable(result)
 
 
 # Example actions
@@ -322,6 +648,7 @@ def add_numbers(num1, num2):
     return int(num1) + int(num2)
 
 if __name__ == "__main__":
+    Metrics.get_instance().enable()
     action_parser = PromethiaParser()
     action_parser.register_action(greet)
     action_parser.register_action(add_numbers)
@@ -353,12 +680,34 @@ if __name__ == "__main__":
     
     action_parser.parse_string("unknown action", verbose=True)
 
+    # misspelled tokens are resolved without the embedding model
+    action_parser.parse_string("say helo to Carol", verbose=True)
+    assert action_parser.last_result == "Hello, Carol!"
+
+    # ordinary words close to a token ("kind" to "find", "strong" to "string") stay part of the param
+    action_parser.parse_string("say hello to my kind friend", verbose=True)
+    assert action_parser.last_result == "Hello, my kind friend!"
+    action_parser.parse_string("say hello to the strong wind", verbose=True)
+    assert action_parser.last_result == "Hello, the strong wind!"
+    print(f"Word resolution tiers: {action_parser.word_resolver.get_stats()}")
+
     action_parser.parse_string("say hello to bucket and add 1 plus 1", verbose=True)
     assert action_parser.last_result == 2
 
     action_parser.parse_string("I'mma gonna say hello to bucket and add 1 plus 1", verbose=True)
     assert action_parser.last_result == 2
 
+    # a trailing stop token just ends the action
+    action_parser.parse_string("say hello to Alice and", verbose=True)
+    assert action_parser.last_result == "Hello, Alice!"
+
+    # an unregistered action is gone from the trie, registering it again brings it back
+    action_parser.unregister_action(greet)
+    action_parser.parse_string("say hello to Alice", verbose=True)
+    assert action_parser.last_result == "Hello, Alice!" and action_parser.last_calls == []
+    action_parser.register_action(greet)
+    action_parser.reload_actions()
+
     # delete wikigolem.txt if it exists
     if os.path.exists("wikigolem.txt"):
         os.remove("wikigolem.txt")
@@ -380,7 +729,47 @@ if __name__ == "__main__":
     action_parser.parse_string("save golem_page to a file named 'golem_page.txt'")
     assert os.path.exists("golem_page.txt")
 
+    # files are copied through a handle, without reading them into a variable
+    action_parser.parse_string("get file named 'golem_page.txt' and save it to a file named 'golem_copy.txt'")
+    with open("golem_page.txt", "r", encoding="utf-8") as f, open("golem_copy.txt", "r", encoding="utf-8") as g:
+        assert f.read() == g.read()
+    os.remove("golem_copy.txt")
+
+    # a file read into a variable keeps its contents when the file is overwritten afterwards
+    with open("notes.txt", "w", encoding="utf-8") as f:
+        f.write("original notes")
+    action_parser.parse_string("get file named 'notes.txt' and save it to variable backup")
+    action_parser.parse_string("save 'new text' to file named 'notes.txt'")
+    action_parser.parse_string("save backup to file named 'backup.txt'")
+    with open("backup.txt", "r", encoding="utf-8") as f:
+        assert f.read() == "original notes"
+    os.remove("notes.txt")
+    os.remove("backup.txt")
+
+    action_parser.parse_string("remember 'Puffins nest in burrows and eat small fish' as 'puffin notes'")
+    action_parser.parse_string("recall from memory what puffins eat", verbose=True)
+    assert "burrows" in action_parser.last_result
+    os.remove(os.path.join(MemoryMap.get_instance().memory_path, "puffin notes.txt"))
+
+    # compile a batch of lines on all cores, without running any of the actions
+    lines = ["say hello to Dana", "add 1 plus 2 and add 3 plus 4", "search wikipedia for 'golem'"]
+    compiled = list(action_parser.parse_lines(lines, workers=2, dry_run=True))
+    assert compiled[1] == ([("add_numbers", ["1", "2"]), ("add_numbers", ["3", "4"])], None)
+
+    # parsers in other processes can map the vocabulary index of this one instead of embedding it again
+    prefix = action_parser.share_semantic_mapper()
+    shared_parser = PromethiaParser(shared_semantic_prefix=prefix, embedding_model=action_parser.semantic_mapper.model)
+    shared_parser.register_action(greet)
+    shared_parser.parse_string("say hello to Dana")
+    assert shared_parser.last_result == "Hello, Dana!"
+
+    # values that can not be pickled come back from the workers as their repr, in the calls as in the results
+    VariableMap.get_instance().set_data("guard", threading.Lock())
+    compiled = list(action_parser.parse_lines(["say hello to guard"] * 2, workers=2))
+    assert compiled[0][0][0][1][0].startswith("<unlocked _thread.lock") and compiled[0][1].startswith("Hello, ")
+
     print("Done running actions successfully!")
+    print(f"Metrics: {Metrics.get_instance().snapshot()}")
 
     # perform a web search
     # remove the file rachel alucard.txt if it exists
@@ -0,0 +1,191 @@
+# defines ResultCache, a named, process-wide cache for the results of slow actions
+# identical calls made while a result is being computed wait for that result instead of making their own call
+
+import json
+import os
+import threading
+import time
+
+from Metrics import Metrics
+
+
+class ResultCache:
+    __caches = {}
+    __caches_lock = threading.Lock()
+
+    @staticmethod
+    def get_cache(name, ttl=300, persist_path=None, max_entries=1024):
+        """Return the cache with the given name, creating it with the given settings on first use."""
+        with ResultCache.__caches_lock:
+            if name not in ResultCache.__caches:
+                ResultCache.__caches[name] = ResultCache(name, ttl, persist_path, max_entries)
+            return ResultCache.__caches[name]
+
+    @staticmethod
+    def make_key(query, casefold=True, **params):
+        """
+        Build a cache key from a query and the call parameters. Whitespace in the query is always normalized, case
+        only with casefold, for backends where case does not change the result.
+        """
+        normalized_query = " ".join(str(query).split())
+        if casefold:
+            normalized_query = normalized_query.casefold()
+        return json.dumps([normalized_query, params], sort_keys=True, default=str)
+
+    def __init__(self, name, ttl=300, persist_path=None, max_entries=1024):
+        self.name = name
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expiry time, result)
+        self.entries = {}
+        # key -> the call that is currently computing the result for that key
+        self.in_flight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+        if persist_path is not None:
+            self.load()
+
+    def get_or_compute(self, key, compute):
+        """Return the cached result for key, or call compute() once to get it, however many callers ask at once."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.stats["hits"] += 1
+                Metrics.get_instance().increment(f"cache.{self.name}.hits")
+                return entry[1]
+
+            flight = self.in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self.in_flight[key] = flight
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        Metrics.get_instance().increment(f"cache.{self.name}.{'misses' if is_leader else 'coalesced'}")
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+            self.put(key, flight.result)
+            return flight.result
+        except Exception as e:
+            # errors are handed to the waiting callers but never cached
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+    def put(self, key, result):
+        with self.lock:
+            now = time.time()
+            self.entries[key] = (now + self.ttl, result)
+
+            if len(self.entries) > self.max_entries:
+                self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+                # still too many live entries, so drop the ones that would expire first
+                while len(self.entries) > self.max_entries:
+                    del self.entries[min(self.entries, key=lambda k: self.entries[k][0])]
+
+            if self.persist_path is not None:
+                self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            if self.persist_path is not None:
+                self.save()
+
+    def load(self):
+        try:
+            with open(self.persist_path, 'r', encoding="utf-8") as f:
+                saved_entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        self.entries = {key: (expires, result) for key, (expires, result) in saved_entries.items() if expires > now}
+
+    def save(self):
+        # results that can not be written as json are only kept in memory
+        saved_entries = {}
+        for key, entry in self.entries.items():
+            try:
+                json.dumps(entry[1])
+            except (TypeError, ValueError):
+                continue
+            saved_entries[key] = entry
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.persist_path)), exist_ok=True)
+        temp_file = f"{self.persist_path}.{os.getpid()}.tmp"
+        with open(temp_file, 'w', encoding="utf-8") as f:
+            json.dump(saved_entries, f)
+        os.replace(temp_file, self.persist_path)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+if __name__ == "__main__":
+    # Example usage of the ResultCache, with stub backends standing in for wikipedia and DuckDuckGo
+    import importlib.util
+    from concurrent.futures import ThreadPoolExecutor
+
+    spec = importlib.util.spec_from_file_location("SearchActions", "promethia-actions/SearchActions.py")
+    search_actions = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(search_actions)
+
+    upstream_calls = []
+
+    class StubWikipedia:
+        @staticmethod
+        def summary(query, auto_suggest=True):
+            upstream_calls.append(query)
+            time.sleep(0.2)
+            return f"Summary of {query}"
+
+    class StubDDGS:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def text(self, query, max_results=5):
+            upstream_calls.append(query)
+            time.sleep(0.2)
+            return [{"title": query, "href": "http://localhost/", "body": "stub"}]
+
+    search_actions.wikipedia = StubWikipedia
+    search_actions.DDGS = StubDDGS
+    search_actions.wikipedia_cache.clear()
+    search_actions.duckduckgo_cache.clear()
+
+    # concurrent identical requests are coalesced into one upstream call
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(search_actions.search_wikipedia_0, ["Golem"] * 4 + ["  Golem "] * 4))
+    assert results == ["Summary of Golem"] * 8
+    assert upstream_calls == ["Golem"]
+
+    # wikipedia titles are case sensitive after the first letter, so they are cached apart
+    assert search_actions.search_wikipedia_0("Red Dwarf") == "Summary of Red Dwarf"
+    assert search_actions.search_wikipedia_0("Red dwarf") == "Summary of Red dwarf"
+    del upstream_calls[1:]
+
+    # later calls within the ttl are served from the cache
+    search_actions.duckduckgo_search_0("Rachel Alucard")
+    search_actions.duckduckgo_search_0("rachel alucard")
+    assert len(upstream_calls) == 2
+    print(search_actions.wikipedia_cache.stats, search_actions.duckduckgo_cache.stats)
@@ -1,9 +1,16 @@
+import atexit
+import json
+import os
 import re
+import tempfile
 
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import faiss
 
+from Metrics import Metrics
+import TextUtils
+
 
 class SemanticMapper:
     def __init__(self, ids_to_descriptions = None, similarity_threshold = 0.7, embedding_model = None):
@@ -11,6 +18,8 @@ class SemanticMapper:
         self.ids = []
         self.d = 0
         self.index = None
+        # set when the index and ids are mapped from files shared with other processes (see load_shared)
+        self.shared_prefix = None
         self.pronouns = ["it",  "him", "her", "that"]
         self.articles = ["the", "a", "an"]
         self.conjunctions = ["and"]
@@ -34,39 +43,115 @@ class SemanticMapper:
             self.id_to_descriptions = {}
 
     def add_id_and_descriptions(self, new_id, description_list, force_rebuild=False):
-        self.id_to_descriptions[new_id] = description_list + [new_id]
+        if new_id in self.id_to_descriptions and not force_rebuild:
+            self.remove_id(new_id)
+        descriptions = description_list + [new_id]
+        self.id_to_descriptions[new_id] = descriptions
 
-        if force_rebuild:
+        # a shared index is mapped read-only, so it can only be replaced by a private one
+        if force_rebuild or self.index is None or self.shared_prefix is not None:
             self.build_index()
         else:
-            self.words += description_list
-            self.ids += [new_id] * len(description_list)
-            added_x = self.model.encode(description_list)
+            self.words += descriptions
+            self.ids += [new_id] * len(descriptions)
+            added_x = self.encode(descriptions)
             self.index.add(added_x)
 
-    def remove_id(self, id):
+    def remove_id(self, id, force_rebuild=False):
         del self.id_to_descriptions[id]
-        self.build_index()
+
+        if force_rebuild or self.shared_prefix is not None:
+            self.build_index()
+        else:
+            # only the rows of this id are dropped, the index keeps the other rows in order just like words and ids
+            rows = [row for row, row_id in enumerate(self.ids) if row_id == id]
+            self.index.remove_ids(np.array(rows, dtype=np.int64))
+            self.words = [word for word, row_id in zip(self.words, self.ids) if row_id != id]
+            self.ids = [row_id for row_id in self.ids if row_id != id]
 
     def build_index(self):
+        self.words = []
+        self.ids = []
+        self.shared_prefix = None
         for key in self.id_to_descriptions:
             self.words += self.id_to_descriptions[key]
             self.ids += [key] * len(self.id_to_descriptions[key])
 
-        x = self.model.encode(self.words)
+        x = self.encode(self.words)
         self.d = x.shape[1]
         self.index = faiss.IndexFlatL2(self.d)
         self.index.add(x)
 
+    def save_shared(self, prefix=None):
+        """
+        Write the index and the id table to files that other processes can map with load_shared, so that they
+        share one physical copy instead of each holding their own. By default the files go to /dev/shm, which is
+        memory backed, and are deleted when this process exits. Returns the prefix of the files.
+        """
+        if prefix is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            prefix = os.path.join(directory, f"promethia-semantic-{os.getpid()}-{id(self)}")
+            atexit.register(SemanticMapper.remove_shared_at_exit, prefix, os.getpid())
+
+        # ids are stored as positions into the list of keys, so the table is a flat array that can be mapped
+        keys = list(self.id_to_descriptions)
+        key_positions = {key: position for position, key in enumerate(keys)}
+        np.save(f"{prefix}.ids.npy", np.array([key_positions[id] for id in self.ids], dtype=np.int32))
+        faiss.write_index(self.index, f"{prefix}.faiss")
+        with open(f"{prefix}.json", 'w', encoding="utf-8") as f:
+            json.dump({"keys": keys, "words": self.words, "id_to_descriptions": self.id_to_descriptions,
+                       "threshold": self.threshold}, f)
+        return prefix
+
+    @staticmethod
+    def load_shared(prefix, embedding_model=None):
+        """Return a semantic mapper whose index and id table are mapped read-only from the files of save_shared."""
+        with open(f"{prefix}.json", 'r', encoding="utf-8") as f:
+            shared = json.load(f)
+
+        semantic_mapper = SemanticMapper(None, shared["threshold"], embedding_model)
+        semantic_mapper.id_to_descriptions = shared["id_to_descriptions"]
+        semantic_mapper.words = shared["words"]
+        semantic_mapper.ids = SharedIds(shared["keys"], np.load(f"{prefix}.ids.npy", mmap_mode='r'))
+        semantic_mapper.index = TextUtils.readIndex(f"{prefix}.faiss", use_mmap=True)
+        semantic_mapper.d = semantic_mapper.index.d
+        semantic_mapper.shared_prefix = prefix
+        return semantic_mapper
+
+    @staticmethod
+    def remove_shared(prefix):
+        """Delete the files written by save_shared. Processes that already mapped them keep working."""
+        for suffix in (".ids.npy", ".faiss", ".json"):
+            try:
+                os.remove(prefix + suffix)
+            except OSError:
+                pass
+
+    @staticmethod
+    def remove_shared_at_exit(prefix, owner_pid):
+        # forked children inherit the exit handlers of the process that wrote the files, and must leave them be
+        if os.getpid() == owner_pid:
+            SemanticMapper.remove_shared(prefix)
+
+    def encode(self, text):
+        metrics = Metrics.get_instance()
+        metrics.increment("semantic.embedding_calls")
+        with metrics.timer("semantic.encode"):
+            return self.model.encode(text)
+
+    def search(self, x, k):
+        with Metrics.get_instance().timer("semantic.search"):
+            return self.index.search(x, k)
+
     def parse_word(self, word, verbose=False):
         filter_word = self.filter_special_word(word)
         if filter_word is not None:
             return filter_word
 
         # get the embeddings for the words
-        test_embedding = self.model.encode(word)
+        test_embedding = self.encode(word)
 
-        D, I = self.index.search(np.array([test_embedding]), 1)
+        D, I = self.search(np.array([test_embedding]), 1)
         matching_indices = I[0]
 
         # filter out the words that are not similar enough
@@ -96,6 +181,24 @@ class SemanticMapper:
 
         return matching_id
 
+    def parse_words(self, words):
+        """Map a list of words to ids, encoding all of them in one batch and searching the index once."""
+        matching_ids = [self.filter_special_word(word) for word in words]
+        pending = [i for i, matching_id in enumerate(matching_ids) if matching_id is None]
+        if not pending:
+            return matching_ids
+
+        test_embeddings = self.encode([words[i] for i in pending])
+        D, I = self.search(np.asarray(test_embeddings, dtype=np.float32), 1)
+
+        for row, i in enumerate(pending):
+            if I[row][0] >= 0 and D[row][0] < self.threshold:
+                matching_ids[i] = self.ids[I[row][0]]
+            else:
+                matching_ids[i] = "_unknown_"
+
+        return matching_ids
+
     def filter_special_word(self, word):
         # if the word is a pronoun, then replace it with the last result
         if word in self.pronouns:
@@ -107,6 +210,20 @@ class SemanticMapper:
         return None
 
 
+class SharedIds:
+    """The id of every row of a shared index, read from a mapped array of positions into the list of keys."""
+
+    def __init__(self, keys, positions):
+        self.keys = keys
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, row):
+        return self.keys[self.positions[row]]
+
+
 if __name__ == "__main__":
     id_to_descriptions = {}
     id_to_descriptions['put'] = ["put", "place", "set", "store"]
@@ -132,3 +249,14 @@ if __name__ == "__main__":
 
     sm.parse_word("zap!!", verbose=True)
 
+    # map several words with a single encode and search
+    start = time.time()
+    print(sm.parse_words(["grab", "encyclopedia", "inside", "the", "zap!!"]))
+    print(f"Time to map a batch of words: {time.time() - start}")
+
+    # share the index with other processes through memory mapped files
+    prefix = sm.save_shared()
+    shared_sm = SemanticMapper.load_shared(prefix, embedding_model=sm.model)
+    assert shared_sm.parse_words(["grab", "encyclopedia"]) == sm.parse_words(["grab", "encyclopedia"])
+    SemanticMapper.remove_shared(prefix)
+
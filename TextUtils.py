@@ -1,4 +1,7 @@
 import glob
+import json
+import logging
+import math
 import os
 import re
 
@@ -7,6 +10,22 @@ from sentence_transformers import SentenceTransformer
 import faiss
 import hashlib
 
+from Metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# terms of the inverted index are runs of word characters, lower cased
+TERM_PATTERN = re.compile(r"\w+")
+# code points that separate words, and that end a sentence, when cutting text into chunks
+WHITESPACE_CODES = np.array([9, 10, 11, 12, 13, 32, 0x85, 0xA0, 0x2028, 0x2029, 0x3000], dtype=np.uint32)
+SENTENCE_END_CODES = np.array([ord("."), ord("!"), ord("?")], dtype=np.uint32)
+# one segment in this many starts a new chunk, so that copies of the same text are cut in the same places
+CHUNK_ANCHOR_PERIOD = 4
+# part of the name of indexes cached from chunks, changed whenever the chunk layout does so older caches are not read
+CHUNK_CACHE_VERSION = "chunks-v3"
+# segments are hashed as polynomials of their code points in this base, modulo 2**64
+SEGMENT_HASH_BASE = 0x100000001B3
+
 
 def getTextPage(text_string, page_num, characters_per_page=256, overlap=64):
     """
@@ -34,6 +53,296 @@ def getListOfOverlappedPages(text_string, characters_per_page=256, overlap=64):
     return pages
 
 
+def getCodePoints(text_string):
+    """
+    Given a text string, return its code points as a numpy array, so that offsets into the array are offsets into
+    the string.
+    """
+    return np.frombuffer(text_string.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+
+
+def isWhitespace(codes):
+    """
+    Given a numpy array of code points, return a numpy array that is True where the code point is whitespace.
+    """
+    # comparisons are quicker than np.isin, which is only left for the few code points beyond ascii
+    is_space = (codes == 32) | ((codes >= 9) & (codes <= 13))
+    beyond_ascii = np.flatnonzero(codes >= 0x85)
+    if len(beyond_ascii) > 0:
+        is_space[beyond_ascii] = np.isin(codes[beyond_ascii], WHITESPACE_CODES)
+    return is_space
+
+
+def getChunkBoundaries(text_string):
+    """
+    Given a text string, return two sorted numpy arrays of the offsets where a chunk can be cut: the offsets that
+    start a sentence or a line, and the offsets that start a word. Both include the start and the end of the text.
+    """
+    codes = getCodePoints(text_string)
+    num_characters = len(codes)
+    # whitespace is assumed before and after the text, so that the first and last words are found too
+    is_space = np.concatenate(([True], isWhitespace(codes), [True]))
+    word_starts = np.flatnonzero(is_space[:-1] & ~is_space[1:])
+    word_ends = np.flatnonzero(~is_space[:-1] & is_space[1:])
+
+    # a word starts a sentence if the word before it ends with a full stop, or a line break comes between them
+    # (the first word has no word before it, and is given its own end so that it starts one too)
+    previous_ends = np.concatenate((word_ends[:1], word_ends[:-1]))
+    line_breaks = np.flatnonzero(codes == 10)
+    starts_sentence = ((previous_ends >= word_starts) | np.isin(codes[previous_ends - 1], SENTENCE_END_CODES)
+                       | (np.searchsorted(line_breaks, word_starts) > np.searchsorted(line_breaks, previous_ends)))
+
+    # word starts are already sorted and unique, and a repeated 0 does not change where offsets snap to
+    sentence_boundaries = np.concatenate(([0], word_starts[starts_sentence], [num_characters]))
+    word_boundaries = np.concatenate(([0], word_starts, [num_characters]))
+    return sentence_boundaries, word_boundaries
+
+
+def snapOffsetsToBoundaries(offsets, boundary_arrays, max_shift):
+    """
+    Given a numpy array of offsets, move each offset back to the closest boundary at most max_shift characters
+    before it, trying the boundary arrays in order. Offsets without a boundary in reach stay where they are.
+    """
+    snapped = offsets.copy()
+    unsnapped = np.ones(len(offsets), dtype=bool)
+    for boundaries in boundary_arrays:
+        closest = boundaries[np.maximum(np.searchsorted(boundaries, offsets, side="right") - 1, 0)]
+        in_reach = unsnapped & (closest <= offsets) & (offsets - closest <= max_shift)
+        snapped[in_reach] = closest[in_reach]
+        unsnapped &= ~in_reach
+    return snapped
+
+
+def getChunkSegments(text_string, characters_per_chunk=256, overlap=64, max_shift=None):
+    """
+    Given a text string, return the start and end offsets of its segments and the number of the line each one is on,
+    as three numpy arrays. The segments are the lines with the whitespace around them trimmed, and blank lines are
+    left out. Lines longer than a chunk are cut into pieces laid out like the pages of getListOfOverlappedPages, whose
+    starts and ends are moved back by up to max_shift characters (the overlap by default, so that pieces still meet)
+    to the start of a sentence, or failing that the start of a word.
+    """
+    codes = getCodePoints(text_string)
+    non_space = np.flatnonzero(~isWhitespace(codes))
+    if len(non_space) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    line_breaks = np.flatnonzero(codes == 10)
+    line_starts = np.concatenate(([0], line_breaks + 1))
+    line_ends = np.concatenate((line_breaks, [len(codes)]))
+    # the first and last characters of each line that are not whitespace, as positions into non_space
+    first = np.searchsorted(non_space, line_starts)
+    last = np.searchsorted(non_space, line_ends) - 1
+    lines = np.flatnonzero(first <= last)
+    starts = non_space[first[lines]]
+    ends = non_space[last[lines]] + 1
+
+    long_lines = np.flatnonzero(ends - starts > characters_per_chunk)
+    if len(long_lines) == 0:
+        return starts, ends, lines
+
+    # the grid of the pages, laid over every long line at once
+    step = characters_per_chunk - overlap
+    line_lengths = ends[long_lines] - starts[long_lines]
+    num_pieces = np.maximum(1, -(-(line_lengths - overlap) // step))
+    piece_lines = np.repeat(long_lines, num_pieces)
+    piece_numbers = np.arange(num_pieces.sum()) - np.repeat(np.cumsum(num_pieces) - num_pieces, num_pieces)
+    piece_starts = starts[piece_lines] + piece_numbers * step
+    piece_ends = np.minimum(piece_starts + characters_per_chunk, ends[piece_lines])
+
+    # the ends of the long lines are boundaries too, so that no piece is snapped into the line before it
+    if max_shift is None:
+        max_shift = overlap
+    sentence_boundaries, word_boundaries = getChunkBoundaries(text_string)
+    boundary_arrays = (np.union1d(sentence_boundaries, np.concatenate((starts[long_lines], ends[long_lines]))),
+                       word_boundaries)
+    piece_starts = snapOffsetsToBoundaries(piece_starts, boundary_arrays, max_shift)
+    piece_ends = snapOffsetsToBoundaries(piece_ends, boundary_arrays, max_shift)
+
+    short_lines = np.flatnonzero(ends - starts <= characters_per_chunk)
+    starts = np.concatenate((starts[short_lines], piece_starts))
+    ends = np.concatenate((ends[short_lines], piece_ends))
+    lines = np.concatenate((lines[short_lines], lines[piece_lines]))
+    order = np.lexsort((starts, lines))
+    return starts[order], ends[order], lines[order]
+
+
+def getSegmentHashes(codes, starts, ends):
+    """
+    Given the code points of a text (see getCodePoints) and the start and end offsets of segments of it, return a
+    64 bit hash of the text of each segment as a numpy array. Only the code points of the segments are read, in one
+    pass over all of them.
+    """
+    lengths = ends - starts
+    if len(lengths) == 0 or lengths.sum() == 0:
+        return np.zeros(len(lengths), dtype=np.uint64)
+    segment_offsets = np.cumsum(lengths) - lengths
+    # the position of each character within its segment, and the position of the character in the text
+    positions = np.arange(lengths.sum()) - np.repeat(segment_offsets, lengths)
+    powers = np.ones(lengths.max(), dtype=np.uint64)
+    np.cumprod(np.full(len(powers) - 1, SEGMENT_HASH_BASE, dtype=np.uint64), out=powers[1:])
+    # unsigned numpy arithmetic wraps around, which is the modulo 2**64 of the hash
+    terms = codes[np.repeat(starts, lengths) + positions].astype(np.uint64) * powers[positions]
+    hashes = np.zeros(len(lengths), dtype=np.uint64)
+    non_empty = lengths > 0
+    hashes[non_empty] = np.add.reduceat(terms, segment_offsets[non_empty])
+    return hashes
+
+
+def getChunkOffsets(text_string, characters_per_chunk=256, overlap=64, max_shift=None):
+    """
+    Given a text string, return the start and end offsets of its chunks, as two numpy arrays.
+    The text is cut into segments by getChunkSegments, which are packed into chunks of up to characters_per_chunk
+    characters. Where the cuts go depends on the segments alone, not on where they are in the text: a chunk ends at
+    a blank line, between a segment that repeats in the text and one that does not, around the pieces of a long
+    line and before an anchor segment (one segment in CHUNK_ANCHOR_PERIOD, picked by its hash). So repeated headers,
+    footers and reference lists come out as the same chunks wherever they are, and an edit only changes the chunks
+    around it. The cuts are found with numpy, and only the packing of the segments between two cuts walks the chunks.
+    A chunk cut from the one before it within a passage (not at a blank line or where repeated text starts or stops)
+    also takes up to overlap characters from the end of that chunk, from the start of a sentence or a word, so that
+    context that spans the cut is kept. Those chunks are packed to characters_per_chunk - overlap characters first,
+    like the pages of getListOfOverlappedPages, and never grow past characters_per_chunk. The pieces of long lines overlap already.
+    """
+    starts, ends, lines = getChunkSegments(text_string, characters_per_chunk, overlap, max_shift)
+    num_segments = len(starts)
+    if num_segments == 0:
+        return starts, ends
+
+    is_piece = np.zeros(num_segments, dtype=bool)
+    is_piece[1:] |= lines[1:] == lines[:-1]
+    is_piece[:-1] |= lines[:-1] == lines[1:]
+    # the pieces of long lines are chunks of their own anyway, so only the other segments are hashed
+    whole_lines = np.flatnonzero(~is_piece)
+    hashes = np.zeros(num_segments, dtype=np.uint64)
+    hashes[whole_lines] = getSegmentHashes(getCodePoints(text_string), starts[whole_lines], ends[whole_lines])
+    _, hash_positions, hash_counts = np.unique(hashes[whole_lines], return_inverse=True, return_counts=True)
+    repeated = np.zeros(num_segments, dtype=bool)
+    repeated[whole_lines] = hash_counts[hash_positions] > 1
+
+    # hard cuts end a passage, and no overlap is carried across them, so that repeated text stays the same chunks
+    hard_cuts = np.ones(num_segments, dtype=bool)
+    hard_cuts[1:] = (lines[1:] - lines[:-1] > 1) | (repeated[1:] != repeated[:-1])
+    cuts = hard_cuts.copy()
+    cuts[1:] |= (is_piece[1:] | is_piece[:-1] | ((hashes[1:] >> np.uint64(32)) % np.uint64(CHUNK_ANCHOR_PERIOD) == 0))
+    carries = ~hard_cuts & ~is_piece
+    run_starts = np.flatnonzero(cuts)
+    run_ends = np.concatenate((run_starts[1:], [num_segments]))
+
+    # most runs fit in one chunk, the others are packed so that each chunk takes the segments that end within
+    # its size of its start (and at least one), leaving room for the overlap in the chunks that carry it
+    carried_size = characters_per_chunk - overlap
+    run_sizes = np.where(carries[run_starts], carried_size, characters_per_chunk)
+    fits = ends[run_ends - 1] - starts[run_starts] <= run_sizes
+    chunk_firsts = run_starts[fits].tolist()
+    packed_ends = np.searchsorted(ends, starts + carried_size, side="right")
+    full_packed_ends = np.searchsorted(ends, starts + characters_per_chunk, side="right")
+    for run_start, run_end in zip(run_starts[~fits].tolist(), run_ends[~fits].tolist()):
+        first = run_start
+        while first < run_end:
+            chunk_firsts.append(first)
+            packed_end = packed_ends[first] if carries[first] else full_packed_ends[first]
+            first = min(max(int(packed_end), first + 1), run_end)
+
+    chunk_firsts = np.sort(np.array(chunk_firsts, dtype=np.int64))
+    chunk_lasts = np.concatenate((chunk_firsts[1:], [num_segments])) - 1
+    chunk_starts = starts[chunk_firsts]
+    chunk_ends = ends[chunk_lasts]
+
+    # the overlap is taken back to the first sentence in reach, or failing that the first word
+    carried = np.flatnonzero(carries[chunk_firsts])
+    if overlap > 0 and len(carried) > 0:
+        # no further back than the chunk before, nor so far that the chunk grows past characters_per_chunk
+        targets = np.maximum(np.maximum(chunk_starts[carried] - overlap, chunk_starts[carried - 1]),
+                             chunk_ends[carried] - characters_per_chunk)
+        new_starts = chunk_starts[carried]
+        unsnapped = np.ones(len(carried), dtype=bool)
+        for boundaries in getChunkBoundaries(text_string):
+            closest = boundaries[np.minimum(np.searchsorted(boundaries, targets), len(boundaries) - 1)]
+            in_reach = unsnapped & (closest >= targets) & (closest < new_starts)
+            new_starts[in_reach] = closest[in_reach]
+            unsnapped &= ~in_reach
+        chunk_starts[carried] = new_starts
+    return chunk_starts, chunk_ends
+
+
+def getListOfChunks(text_string, characters_per_chunk=256, overlap=64, max_shift=None):
+    """
+    Given a text string, return a list of chunks that are cut between lines, and between sentences or words in lines
+    longer than a chunk. See getChunkOffsets.
+    """
+    starts, ends = getChunkOffsets(text_string, characters_per_chunk, overlap, max_shift)
+    return [text_string[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def getChunkHash(chunk):
+    """
+    Given a chunk, return the hash of its text with runs of whitespace collapsed, so that reflowed copies match.
+    """
+    return calculateHashForString(" ".join(chunk.split()))
+
+
+def getDeduplicatedChunks(chunks):
+    """
+    Given a list of chunks, return the list of distinct chunks and, for each chunk, the position of its copy in that
+    list. Chunks are compared by getChunkHash.
+    """
+    unique_chunks = []
+    positions = {}
+    chunk_positions = []
+    for chunk in chunks:
+        chunk_hash = getChunkHash(chunk)
+        position = positions.get(chunk_hash)
+        if position is None:
+            position = positions[chunk_hash] = len(unique_chunks)
+            unique_chunks.append(chunk)
+        chunk_positions.append(position)
+    return unique_chunks, chunk_positions
+
+
+def convertChunksToEmbeddings(chunks, model, known_embeddings=None):
+    """
+    Given a list of chunks, embed each distinct chunk once, in one batch, and return an array with a row per chunk.
+    known_embeddings optionally maps chunk hashes to the embeddings of chunks seen before (in an earlier document or
+    an earlier version of this one), and those are not embedded again.
+    Also returns the stats of the document: the number of chunks, of distinct chunks and of chunks embedded, the
+    deduplication ratio (the share of chunks that were copies) and the embedding calls saved.
+    """
+    unique_chunks, chunk_positions = getDeduplicatedChunks(chunks)
+    unique_embeddings = [None] * len(unique_chunks)
+    if known_embeddings:
+        for position, chunk in enumerate(unique_chunks):
+            unique_embeddings[position] = known_embeddings.get(getChunkHash(chunk))
+    pending = [position for position, embedding in enumerate(unique_embeddings) if embedding is None]
+
+    stats = {
+        "chunks": len(chunks),
+        "unique_chunks": len(unique_chunks),
+        "embedded_chunks": len(pending),
+        "deduplication_ratio": 1 - len(unique_chunks) / len(chunks) if chunks else 0.0,
+        "embedding_calls_saved": len(chunks) - len(pending),
+    }
+    if not chunks:
+        return np.zeros((0, 0), dtype=np.float32), stats
+
+    metrics = Metrics.get_instance()
+    metrics.increment("textutils.embedding_calls", len(pending))
+    metrics.increment("textutils.embedding_calls_saved", stats["embedding_calls_saved"])
+    if pending:
+        with metrics.timer("textutils.encode"):
+            embeddings = model.encode([unique_chunks[position] for position in pending])
+        for position, embedding in zip(pending, embeddings):
+            unique_embeddings[position] = embedding
+    return np.asarray(unique_embeddings, dtype=np.float32)[chunk_positions], stats
+
+
+def logChunkStats(name, stats):
+    """
+    Given the name of a document and the stats convertChunksToEmbeddings returned for it, log them.
+    """
+    logger.debug("Embedded %s: %d pages, %d distinct, %d embedded, %d embeddings saved (%.0f%% duplicates)",
+                 name, stats["chunks"], stats["unique_chunks"], stats["embedded_chunks"],
+                 stats["embedding_calls_saved"], 100 * stats["deduplication_ratio"])
+
+
 def calculateHashForString(text_string):
     """
     Given a text string, return the hash of the string.
@@ -108,17 +417,39 @@ def convertStringListToEmbeddings(page_list, model):
     """
     Given a list of text pages, return a list of embeddings.
     """
-    return [model.encode(page) for page in page_list]
+    metrics = Metrics.get_instance()
+    metrics.increment("textutils.embedding_calls", len(page_list))
+    with metrics.timer("textutils.encode"):
+        return [model.encode(page) for page in page_list]
+
+
+def getMmapReadFlags():
+    """
+    Return the Faiss read flags that map an index file read-only instead of copying it into memory.
+    """
+    # flat indexes are only mapped with IO_FLAG_MMAP_IFC, older Faiss versions only map inverted lists
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def readIndex(cache_file, use_mmap=False):
+    """
+    Given the path to a cached Faiss index, load the index. With use_mmap the file is mapped read-only rather than
+    copied into memory, so every process that opens the same file shares one physical copy of the index.
+    A mapped index can be searched but not added to.
+    """
+    if use_mmap:
+        return faiss.read_index(cache_file, getMmapReadFlags())
+    return faiss.read_index(cache_file)
 
 
-def getIndexFromListOfEmbeddings(embeddings, cache_file=None):
+def getIndexFromListOfEmbeddings(embeddings, cache_file=None, use_mmap=False):
     """
     Given a list of embeddings, return a Faiss index.
     """
     index = None
     if cache_file is not None:
         try:
-            index = faiss.read_index(cache_file)
+            index = readIndex(cache_file, use_mmap)
             return index
         except:
             pass
@@ -129,22 +460,46 @@ def getIndexFromListOfEmbeddings(embeddings, cache_file=None):
 
         if cache_file is not None:
             faiss.write_index(index, cache_file)
+            if use_mmap:
+                # swap the private copy for the shared mapping of the file just written
+                index = readIndex(cache_file, use_mmap)
 
     return index
 
 
-def getIndexFromFile(file_path, model, page_size=256, overlap=64):
+def getListOfPagesForIndex(text_string, page_size=256, overlap=64, use_chunks=False):
+    """
+    Given a text string, return the pages the cached indexes are built from: the overlapped pages, or the chunks of
+    getListOfChunks with use_chunks.
+    """
+    if use_chunks:
+        return getListOfChunks(text_string, page_size, overlap)
+    return getListOfOverlappedPages(text_string, page_size, overlap)
+
+
+def getCacheName(content_hash, use_chunks=False):
+    """
+    Given the hash of the indexed contents, return the name the caches of its index start with. Caches built from
+    chunks are named after the chunk layout too, so they are never mixed up with caches built from pages.
+    """
+    if use_chunks:
+        return f"{content_hash}.{CHUNK_CACHE_VERSION}"
+    return content_hash
+
+
+def getIndexFromFile(file_path, model, page_size=256, overlap=64, use_mmap=False, use_chunks=False):
     index = None
 
     # first, lets get hash of the file
     file_hash = calculateHashForFile(file_path)
 
     # the hash of the file is used to create a cache file
-    cache_file = f"{file_hash}.faiss"
+    cache_name = getCacheName(file_hash, use_chunks)
+    cache_file = f"{cache_name}.faiss"
 
     # if the cache file exists, we can load the index from the cache file
     try:
-        index = faiss.read_index(cache_file)
+        index = readIndex(cache_file, use_mmap)
         return index
     except:
         pass
@@ -153,49 +508,293 @@ def getIndexFromFile(file_path, model, page_size=256, overlap=64):
         # if the index is not loaded from the cache file, we need to create the index
         with open(file_path, 'r', encoding="utf-8") as f:
             text_string = f.read()
-            pages = getListOfOverlappedPages(text_string, page_size, overlap)
-            embeddings = convertStringListToEmbeddings(pages, model)
-            index = getIndexFromListOfEmbeddings(embeddings, cache_file)
+            pages = getListOfPagesForIndex(text_string, page_size, overlap, use_chunks)
+            if use_chunks:
+                # repeated chunks are only embedded once
+                embeddings, stats = convertChunksToEmbeddings(pages, model)
+                logChunkStats(file_path, stats)
+            else:
+                embeddings = convertStringListToEmbeddings(pages, model)
+            index = getIndexFromListOfEmbeddings(embeddings, cache_file, use_mmap)
+            getInvertedIndexFromListOfPages(pages, f"{cache_name}.lexicon.json")
 
     return index
 
 
-def getIndexFromDirectory(directory_path, model, page_size=256, overlap=64):
+def isCacheFile(file_path):
+    """
+    Given a file path, return True if it is an index cache file written during ingestion.
+    """
+    return file_path.endswith('.faiss') or file_path.endswith('.lexicon.json')
+
+
+def removeCacheFilesFromDirectory(directory_path, keep_hash=None):
+    """
+    Given a directory path, remove the index cache files stored in it. The caches of the contents with keep_hash
+    (built from pages or from chunks) are kept, if given.
+    """
+    for file in glob.glob(os.path.join(directory_path, '*')):
+        if isCacheFile(file) and not (keep_hash is not None and os.path.basename(file).startswith(keep_hash + ".")):
+            os.remove(file)
+
+
+def getIndexedFilesInDirectory(directory_path):
+    """
+    Given a directory path, return the sorted list of files that make up the directory index.
+    Cache files stored in the directory are skipped, and the order matches the order of the index rows.
+    """
+    files = [file for file in glob.glob(os.path.join(directory_path, '*'))
+             if os.path.isfile(file) and not isCacheFile(file)]
+    files.sort()
+    return files
+
+
+def getPageSourcesFromDirectory(directory_path, page_size=256, overlap=64, use_chunks=False):
+    """
+    Given a directory path, return a list that maps each row of the directory index to the
+    (file path, page number) it was built from. With use_chunks the page number is the number of the chunk.
+    """
+    page_sources = []
+    for file in getIndexedFilesInDirectory(directory_path):
+        with open(file, 'r', encoding="utf-8") as f:
+            if use_chunks:
+                num_pages = len(getChunkOffsets(f.read(), page_size, overlap)[0])
+            else:
+                num_pages = len(f.read()) // (page_size - overlap)
+        page_sources += [(file, page_number) for page_number in range(num_pages)]
+    return page_sources
+
+
+def getIndexFromDirectory(directory_path, model, page_size=256, overlap=64, use_mmap=False, use_chunks=False):
     index = None
 
     # first, lets get hash of the directory
     directory_hash = calculateHashForDirectory(directory_path)
 
     # the hash of the directory is used to create a cache file in the directory
-    cache_file = os.path.join(directory_path, f"{directory_hash}.faiss")
+    cache_name = getCacheName(directory_hash, use_chunks)
+    cache_file = os.path.join(directory_path, f"{cache_name}.faiss")
 
     # if the cache file exists, we can load the index from the cache file
     try:
-        index = faiss.read_index(cache_file)
+        index = readIndex(cache_file, use_mmap)
         return index
     except:
         pass
 
     if index is None:
         # if there is an old cache file in the directory, we need to remove it
-        old_cache_files = glob.glob(os.path.join(directory_path, '*.faiss'))
-        for old_cache_file in old_cache_files:
-            os.remove(old_cache_file)
+        removeCacheFilesFromDirectory(directory_path, keep_hash=directory_hash)
 
         # if the index is not loaded from the cache file, we need to create the index
-        files = glob.glob(os.path.join(directory_path, '*'))
+        files = getIndexedFilesInDirectory(directory_path)
         embeddings = []
+        all_pages = []
+        # the embeddings of the chunks of the files before, so chunks repeated across files are embedded once
+        known_embeddings = {}
         for file in files:
             with open(file, 'r', encoding="utf-8") as f:
                 text_string = f.read()
-                pages = getListOfOverlappedPages(text_string, page_size, overlap)
-                embeddings += convertStringListToEmbeddings(pages, model)
-
-        index = getIndexFromListOfEmbeddings(embeddings, cache_file)
+                pages = getListOfPagesForIndex(text_string, page_size, overlap, use_chunks)
+                if use_chunks:
+                    file_embeddings, stats = convertChunksToEmbeddings(pages, model, known_embeddings)
+                    logChunkStats(file, stats)
+                    known_embeddings.update(zip(map(getChunkHash, pages), file_embeddings))
+                    embeddings += list(file_embeddings)
+                else:
+                    embeddings += convertStringListToEmbeddings(pages, model)
+                all_pages += pages
+
+        index = getIndexFromListOfEmbeddings(embeddings, cache_file, use_mmap)
+        getInvertedIndexFromListOfPages(all_pages, os.path.join(directory_path, f"{cache_name}.lexicon.json"))
 
     return index
 
 
+def tokenizeForIndex(text_string):
+    """
+    Given a text string, return a list of (term, offset) pairs for the lower cased words in the string.
+    """
+    return [(m.group(0).lower(), m.start()) for m in TERM_PATTERN.finditer(text_string)]
+
+
+def addPagesToInvertedIndex(inverted_index, pages):
+    """
+    Given an inverted index and a list of text pages, add the pages to the index after the pages it already holds.
+    """
+    postings = inverted_index["postings"]
+    page_lengths = inverted_index["page_lengths"]
+    for page in pages:
+        page_id = len(page_lengths)
+        terms = tokenizeForIndex(page)
+        page_offsets = {}
+        for term, offset in terms:
+            page_offsets.setdefault(term, []).append(offset)
+        # page ids only grow, so each posting list stays sorted by page
+        for term, offsets in page_offsets.items():
+            postings.setdefault(term, []).append([page_id, offsets])
+        page_lengths.append(len(terms))
+    return inverted_index
+
+
+def getInvertedIndexFromListOfPages(pages, cache_file=None):
+    """
+    Given a list of text pages, return an inverted index that maps each term to the pages it occurs in,
+    together with the character offsets of the term within each page.
+    """
+    if cache_file is not None:
+        try:
+            with open(cache_file, 'r', encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    inverted_index = addPagesToInvertedIndex({"postings": {}, "page_lengths": []}, pages)
+
+    if cache_file is not None:
+        with open(cache_file, 'w', encoding="utf-8") as f:
+            json.dump(inverted_index, f)
+
+    return inverted_index
+
+
+def getInvertedIndexFromFile(file_path, page_size=256, overlap=64, use_chunks=False):
+    """
+    Given a file path, return the inverted index for the file, loading it from the cache written at ingestion if present.
+    """
+    cache_file = f"{getCacheName(calculateHashForFile(file_path), use_chunks)}.lexicon.json"
+    if os.path.exists(cache_file):
+        return getInvertedIndexFromListOfPages([], cache_file)
+
+    with open(file_path, 'r', encoding="utf-8") as f:
+        pages = getListOfPagesForIndex(f.read(), page_size, overlap, use_chunks)
+    return getInvertedIndexFromListOfPages(pages, cache_file)
+
+
+def getInvertedIndexFromDirectory(directory_path, page_size=256, overlap=64, use_chunks=False):
+    """
+    Given a directory path, return the inverted index for the directory, loading it from the cache written at
+    ingestion if present. Page ids line up with the rows of getIndexFromDirectory.
+    """
+    cache_name = getCacheName(calculateHashForDirectory(directory_path), use_chunks)
+    cache_file = os.path.join(directory_path, f"{cache_name}.lexicon.json")
+    if os.path.exists(cache_file):
+        return getInvertedIndexFromListOfPages([], cache_file)
+
+    pages = []
+    for file in getIndexedFilesInDirectory(directory_path):
+        with open(file, 'r', encoding="utf-8") as f:
+            pages += getListOfPagesForIndex(f.read(), page_size, overlap, use_chunks)
+    return getInvertedIndexFromListOfPages(pages, cache_file)
+
+
+def doKeywordLookup(inverted_index, query_string):
+    """
+    Given an inverted index and a query string, return the (page, offset) pairs of the pages that contain every
+    term of the query. The offsets are those of the first query term within each page.
+    """
+    terms = [term for term, _ in tokenizeForIndex(query_string)]
+    if len(terms) == 0:
+        return []
+
+    postings = inverted_index["postings"]
+    if any(term not in postings for term in terms):
+        return []
+
+    # start from the rarest term, and merge in the posting lists of the others from the shortest up, so a lookup
+    # costs about the length of the rarest list rather than the length of every list
+    first_postings = postings[terms[0]]
+    other_lists = sorted((postings[term] for term in set(terms) if term != terms[0]), key=len)
+    if len(other_lists) == 0:
+        return [(page, offset) for page, offsets in first_postings for offset in offsets]
+
+    # the positions kept are those in the first term's list, whose offsets are returned, so that list is merged last
+    start_is_first = len(first_postings) <= len(other_lists[0])
+    if start_is_first:
+        current_list, merge_lists = first_postings, other_lists
+    else:
+        current_list, merge_lists = other_lists[0], other_lists[1:] + [first_postings]
+    positions = range(len(current_list))
+    for posting_list in merge_lists:
+        kept_positions = []
+        position = 0
+        for current_position in positions:
+            page = current_list[current_position][0]
+            # the next posting is checked before searching, since in dense lists it is usually the page itself
+            if posting_list[position][0] < page:
+                position = findPostingPosition(posting_list, page, position + 1)
+                if position == len(posting_list):
+                    break
+            if posting_list[position][0] == page:
+                kept_positions.append(current_position if start_is_first else position)
+        positions = kept_positions
+        if not start_is_first:
+            current_list = posting_list
+
+    return [(first_postings[position][0], offset) for position in positions for offset in first_postings[position][1]]
+
+
+def findPostingPosition(posting_list, page, low=0):
+    """
+    Given a posting list sorted by page, return the position of the first posting for the page or a later one,
+    searching from position low. The search gallops ahead before it bisects, so skipping far costs the log of
+    the distance skipped.
+    """
+    high = low
+    step = 1
+    while high < len(posting_list) and posting_list[high][0] < page:
+        low = high + 1
+        high += step
+        step *= 2
+    high = min(high, len(posting_list))
+    while low < high:
+        middle = (low + high) // 2
+        if posting_list[middle][0] < page:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def getBM25Scores(inverted_index, query_string, k1=1.5, b=0.75):
+    """
+    Given an inverted index and a query string, return a dict that maps each page containing a query term
+    to its BM25 score.
+    """
+    postings = inverted_index["postings"]
+    page_lengths = inverted_index["page_lengths"]
+    num_pages = len(page_lengths)
+    if num_pages == 0:
+        return {}
+    average_length = max(sum(page_lengths) / num_pages, 1)
+
+    scores = {}
+    for term in set(term for term, _ in tokenizeForIndex(query_string)):
+        term_postings = postings.get(term)
+        if not term_postings:
+            continue
+        idf = math.log(1 + (num_pages - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        for page, offsets in term_postings:
+            tf = len(offsets)
+            length_norm = 1 - b + b * page_lengths[page] / average_length
+            scores[page] = scores.get(page, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * length_norm)
+
+    return scores
+
+
+def normalizeScores(scores):
+    """
+    Given a dict of scores, return the scores min-max scaled to the range [0, 1].
+    """
+    if len(scores) == 0:
+        return {}
+    low = min(scores.values())
+    high = max(scores.values())
+    if high == low:
+        return {key: 1.0 for key in scores}
+    return {key: (value - low) / (high - low) for key, value in scores.items()}
+
+
 def pageNumberToOffset(page_number, page_size=256, overlap=64):
     return page_number * (page_size - overlap)
 
@@ -210,18 +809,124 @@ def getTextAroundPage(text_string, page_number, page_size=256, overlap=64, slice
     return getSliceAroundOffset(text_string, offset, slice_size)
 
 def doSubstringMatch(text_string, query_string):
-    # match all instances of the query string in the text string
-    return [m.start() for m in re.finditer(query_string, text_string)]
+    # match all instances of the query string in the text string (as a literal, not a pattern)
+    matches = []
+    if len(query_string) == 0:
+        return matches
+    offset = text_string.find(query_string)
+    while offset != -1:
+        matches.append(offset)
+        offset = text_string.find(query_string, offset + len(query_string))
+    return matches
 
 def getMostSimilarPages(index, query_embedding, k=3):
     """
     Given a Faiss index, a list of embeddings, a query embedding, and a number of similar pages to return,
     return the indices of the most similar pages.
     """
-    D, I = index.search(np.array([query_embedding]), k)
+    with Metrics.get_instance().timer("textutils.search"):
+        D, I = index.search(np.array([query_embedding]), k)
     return I[0]
 
 
+def arePagesNeighbours(page_a, page_b, page_sources=None):
+    """
+    Given two page indices, return True if they are adjacent pages of the same source (and so overlap).
+    Without page_sources, the index is assumed to hold a single document.
+    """
+    if page_sources is None:
+        return abs(page_a - page_b) == 1
+    source_a, page_number_a = page_sources[page_a]
+    source_b, page_number_b = page_sources[page_b]
+    return source_a == source_b and abs(page_number_a - page_number_b) == 1
+
+
+def getMostSimilarPagesForQueries(index, query_strings, model, k=3, max_distance=None, page_sources=None,
+                                  dedupe_neighbours=True):
+    """
+    Given a Faiss index and a list of query strings, encode all the queries in one batch and search the index once.
+    Returns a list with one entry per query, each a list of up to k hits ordered by distance. A hit is a dict with
+    the page index, its distance and, if page_sources is given, the (file path, page number) it was built from.
+    Hits further away than max_distance are dropped. With dedupe_neighbours, a page next to a closer hit from the
+    same source is skipped, since neighbouring pages share their overlap.
+    """
+    query_strings = list(query_strings)
+    if len(query_strings) == 0 or index.ntotal == 0:
+        return [[] for _ in query_strings]
+
+    metrics = Metrics.get_instance()
+    metrics.increment("textutils.embedding_calls")
+    with metrics.timer("textutils.encode"):
+        query_embeddings = np.asarray(model.encode(query_strings), dtype=np.float32)
+
+    # overfetch when de-duplicating, so that skipped neighbours can be replaced by the next best pages
+    search_k = min(k * 3 if dedupe_neighbours else k, index.ntotal)
+    with metrics.timer("textutils.search"):
+        D, I = index.search(query_embeddings, search_k)
+
+    results = []
+    for distances, pages in zip(D, I):
+        hits = []
+        for distance, page in zip(distances, pages):
+            if page < 0:
+                continue
+            # the distances are sorted, so everything after the first miss is a miss too
+            if max_distance is not None and distance > max_distance:
+                break
+            if dedupe_neighbours and any(arePagesNeighbours(hit["page"], page, page_sources) for hit in hits):
+                continue
+            hits.append({
+                "page": int(page),
+                "distance": float(distance),
+                "source": page_sources[page] if page_sources is not None else None,
+            })
+            if len(hits) == k:
+                break
+        results.append(hits)
+
+    return results
+
+
+def getHybridSimilarPagesForQueries(index, inverted_index, query_strings, model, k=3, semantic_weight=0.5,
+                                    page_sources=None):
+    """
+    Given a Faiss index, the matching inverted index and a list of query strings, return for each query up to k hits
+    ranked by a blend of vector similarity and BM25 score. Both scores are min-max scaled over the candidates of the
+    query before blending with semantic_weight. A hit is a dict with the page index, the blended score, the vector
+    distance (None if the page was only found lexically), the BM25 score and the source of the page.
+    """
+    query_strings = list(query_strings)
+    semantic_results = getMostSimilarPagesForQueries(index, query_strings, model, k=k * 3,
+                                                     page_sources=page_sources, dedupe_neighbours=False)
+
+    results = []
+    for query_string, semantic_hits in zip(query_strings, semantic_results):
+        distances = {hit["page"]: hit["distance"] for hit in semantic_hits}
+        lexical_scores = getBM25Scores(inverted_index, query_string)
+        lexical_candidates = sorted(lexical_scores, key=lexical_scores.get, reverse=True)[:k * 3]
+
+        # closer pages should score higher, so the distances are negated before scaling
+        semantic_scores = normalizeScores({page: -distance for page, distance in distances.items()})
+        lexical_norm = normalizeScores({page: lexical_scores[page] for page in lexical_candidates})
+
+        candidates = set(distances) | set(lexical_candidates)
+        blended = {page: semantic_weight * semantic_scores.get(page, 0.0)
+                   + (1 - semantic_weight) * lexical_norm.get(page, 0.0) for page in candidates}
+
+        hits = []
+        for page in sorted(blended, key=blended.get, reverse=True)[:k]:
+            hits.append({
+                "page": page,
+                "score": blended[page],
+                "distance": distances.get(page),
+                "lexical_score": lexical_scores.get(page, 0.0),
+                "source": page_sources[page] if page_sources is not None else None,
+            })
+        results.append(hits)
+
+    return results
+
+
 if __name__ == "__main__":
     # convert pdf to text
     pdf_file = "promethia-memory/NIPS-2017-attention-is-all-you-need-Paper.pdf"
@@ -229,6 +934,11 @@ if __name__ == "__main__":
 
     text_pages = getListOfOverlappedPages(text)
 
+    # cut between words and sentences instead, and see how many pages repeat
+    chunks = getListOfChunks(text)
+    unique_chunks, _ = getDeduplicatedChunks(chunks)
+    print(f"{len(chunks)} chunks, {len(chunks) - len(unique_chunks)} of them repeats")
+
     # load the model
     model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
 
@@ -250,6 +960,17 @@ if __name__ == "__main__":
         print("-----")
         print()
 
+    # query the index with several questions at once
+    queries = ["attention", "positional encoding", "training data"]
+    for query, hits in zip(queries, getMostSimilarPagesForQueries(index, queries, model, max_distance=1.5)):
+        print(f"'{query}': {[(hit['page'], round(hit['distance'], 3)) for hit in hits]}")
+
+    # blend keyword and vector scores
+    inverted_index = getInvertedIndexFromListOfPages(text_pages)
+    print(f"Pages with 'softmax': {sorted(set(page for page, _ in doKeywordLookup(inverted_index, 'softmax')))}")
+    for query, hits in zip(queries, getHybridSimilarPagesForQueries(index, inverted_index, queries, model)):
+        print(f"'{query}': {[(hit['page'], round(hit['score'], 3)) for hit in hits]}")
+
 
 
 
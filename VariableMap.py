@@ -1,6 +1,10 @@
 # defines a singelton class DataMapper
 # DataMapper keeps a map of strings to values
 
+import logging
+
+logger = logging.getLogger(__name__)
+
 class VariableMap:
     __instance = None
 
@@ -14,12 +18,12 @@ class VariableMap:
         if VariableMap.__instance is not None:
             raise Exception("This class is a singleton!")
         else:
-            print("Creating VariableMap instance")
+            logger.debug("Creating VariableMap instance")
             VariableMap.__instance = self
             self.data_map = {}
 
     def set_data(self, key, value):
-        print(f"Setting value {key}")
+        logger.debug("Setting value %s", key)
         self.data_map[key] = value
 
     def get_data(self, key, verbose=False):
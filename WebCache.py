@@ -0,0 +1,244 @@
+# defines a singleton class WebCache
+# WebCache owns the pooled HTTP session of the web actions and an on-disk cache of the pages they fetch
+
+import email.utils
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+import html2text
+import requests
+from requests.adapters import HTTPAdapter
+
+from Metrics import Metrics
+
+
+class WebCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if WebCache.__instance is None:
+            WebCache()
+        return WebCache.__instance
+
+    def __init__(self, cache_path="./.promethia-cache/http", max_cache_bytes=256 * 1024 * 1024, default_ttl=3600,
+                 timeout=(5, 30), pool_connections=16, pool_maxsize=8):
+        if WebCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            WebCache.__instance = self
+            self.cache_path = cache_path
+            self.max_cache_bytes = max_cache_bytes
+            # seconds a cached page is served without asking the server, unless the server says otherwise
+            self.default_ttl = default_ttl
+            self.timeout = timeout
+            self.lock = threading.Lock()
+            self.cache_bytes = None
+
+            # keep-alive connections, at most pool_maxsize of them per host (further requests wait for a free one)
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True,
+                                  max_retries=2)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    def get_text(self, url):
+        """Return the body of the page at url, from the cache when it is fresh or the server confirms it is unchanged."""
+        key = hashlib.md5(url.encode()).hexdigest()
+        meta = self.read_meta(key)
+
+        if meta is not None and meta["expires"] > time.time():
+            body = self.read_body(key)
+            if body is not None:
+                Metrics.get_instance().increment("cache.http.hits")
+                return body.decode(meta["encoding"], errors="replace")
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and meta is not None:
+            body = self.read_body(key)
+            if body is not None:
+                meta["expires"] = self.get_expiry(response)
+                self.write_meta(key, meta)
+                Metrics.get_instance().increment("cache.http.revalidated")
+                return body.decode(meta["encoding"], errors="replace")
+            # the body was evicted under us, so fetch it again without the validators
+            response = self.session.get(url, timeout=self.timeout)
+
+        Metrics.get_instance().increment("cache.http.misses")
+        if response.status_code == 200 and "no-store" not in response.headers.get("Cache-Control", ""):
+            self.store(key, url, response)
+
+        return response.text
+
+    def get_expiry(self, response):
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-cache" in cache_control:
+            return 0
+        max_age = re.search(r"max-age=(\d+)", cache_control)
+        if max_age is not None:
+            return time.time() + int(max_age.group(1))
+        expires = response.headers.get("Expires")
+        if expires is not None:
+            try:
+                return email.utils.parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                return 0
+        return time.time() + self.default_ttl
+
+    def store(self, key, url, response):
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.encoding or "utf-8",
+            "expires": self.get_expiry(response),
+        }
+        body = response.content
+
+        with self.lock:
+            os.makedirs(self.cache_path, exist_ok=True)
+            old_size = self.get_body_size(key)
+            self.write_file(self.get_file(key, ".body"), body)
+            self.write_meta(key, meta)
+
+            if self.cache_bytes is None:
+                self.cache_bytes = sum(os.path.getsize(os.path.join(self.cache_path, name))
+                                       for name in os.listdir(self.cache_path) if name.endswith(".body"))
+            else:
+                self.cache_bytes += len(body) - old_size
+
+            if self.cache_bytes > self.max_cache_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used pages until the cache fits in max_cache_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_path):
+            if name.endswith(".body"):
+                stat = os.stat(os.path.join(self.cache_path, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-len(".body")]))
+        entries.sort()
+
+        self.cache_bytes = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if self.cache_bytes <= self.max_cache_bytes:
+                break
+            for suffix in (".body", ".json"):
+                try:
+                    os.remove(self.get_file(key, suffix))
+                except OSError:
+                    pass
+            self.cache_bytes -= size
+
+    def get_file(self, key, suffix):
+        return os.path.join(self.cache_path, key + suffix)
+
+    def get_body_size(self, key):
+        try:
+            return os.path.getsize(self.get_file(key, ".body"))
+        except OSError:
+            return 0
+
+    def read_meta(self, key):
+        try:
+            with open(self.get_file(key, ".json"), 'r', encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key, meta):
+        self.write_file(self.get_file(key, ".json"), json.dumps(meta).encode("utf-8"))
+
+    def read_body(self, key):
+        body_file = self.get_file(key, ".body")
+        try:
+            with open(body_file, 'rb') as f:
+                body = f.read()
+            # the modification time doubles as the last use time for eviction
+            os.utime(body_file)
+            return body
+        except OSError:
+            return None
+
+    @staticmethod
+    def write_file(file_path, data):
+        # write to a temporary file first, so that concurrent readers never see a partial file
+        temp_file = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, file_path)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def html_to_text(html_content):
+        """Convert html to text, reusing the conversion when the same page is fetched again."""
+        # HTML2Text keeps the output of earlier pages in its parse state, so a converter only converts one page
+        h = html2text.HTML2Text()
+        h.ignore_links = False
+        return h.handle(html_content)
+
+
+if __name__ == "__main__":
+    # Example usage of the WebCache against a local stand-in server
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requests_served = []
+
+    class PageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_served.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b"<html><body><h1>Golem</h1><p>A golem is an animated being.</p></body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", '"v1"')
+            if self.path == "/revalidate":
+                self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        web_cache = WebCache(cache_path=cache_path)
+
+        # a fresh page is read from disk without contacting the server again
+        assert "Golem" in WebCache.html_to_text(web_cache.get_text(base_url + "/fresh"))
+        assert "Golem" in web_cache.get_text(base_url + "/fresh")
+        assert requests_served == [None]
+
+        # a no-cache page is revalidated with its ETag and served from disk on a 304
+        web_cache.get_text(base_url + "/revalidate")
+        assert "Golem" in web_cache.get_text(base_url + "/revalidate")
+        assert requests_served == [None, None, '"v1"']
+
+        # the cache never grows past its size bound
+        web_cache.max_cache_bytes = 100
+        web_cache.get_text(base_url + "/other")
+        assert web_cache.cache_bytes <= 100
+
+    server.shutdown()
+    print("WebCache works against the local server")
@@ -0,0 +1,198 @@
+# defines WordResolver, which maps words to tokens without the embedding model when it can
+# words are looked up exactly, then case folded, then with a few typos allowed, and only the rest need an embedding
+
+import string
+
+from Metrics import Metrics
+
+
+def get_edit_distance(a, b):
+    """
+    Return the number of insertions, deletions, substitutions and adjacent swaps needed to turn a into b.
+    This is the unrestricted Damerau-Levenshtein distance, which (unlike the restricted one) obeys the triangle
+    inequality that the BK-tree relies on.
+    """
+    unreachable = len(a) + len(b)
+    # the table is offset by one row and column, which hold the unreachable sentinel
+    table = [[unreachable] * (len(b) + 2)] + [[unreachable, i] + [0] * len(b) for i in range(len(a) + 1)]
+    table[1] = [unreachable] + list(range(len(b) + 1))
+    # character -> the last row of a it was seen in
+    last_row = {}
+    for i in range(1, len(a) + 1):
+        # the last column of b, in this row, where the characters matched
+        last_match_column = 0
+        for j in range(1, len(b) + 1):
+            k = last_row.get(b[j - 1], 0)
+            l = last_match_column
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                last_match_column = j
+            else:
+                cost = 1
+            table[i + 1][j + 1] = min(table[i][j] + cost, table[i + 1][j] + 1, table[i][j + 1] + 1,
+                                      # swap a[k - 1] and b[l - 1] back, editing whatever lies between them
+                                      table[k][l] + (i - k - 1) + 1 + (j - l - 1))
+        last_row[a[i - 1]] = i
+    return table[len(a) + 1][len(b) + 1]
+
+
+class BKTree:
+    """A tree of words arranged by edit distance, so that close words can be found without comparing against all."""
+
+    def __init__(self):
+        # each node is (word, {distance: child node})
+        self.root = None
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = get_edit_distance(word, node[0])
+            if distance == 0:
+                return
+            if distance not in node[1]:
+                node[1][distance] = (word, {})
+                return
+            node = node[1][distance]
+
+    def search(self, word, max_distance):
+        """Return the (distance, word) pairs within max_distance of word, closest first."""
+        matches = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = get_edit_distance(word, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[0]))
+            # by the triangle inequality, only children in this band can be close enough
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        matches.sort()
+        return matches
+
+
+class WordResolver:
+    def __init__(self, known_words=None):
+        self.description_to_token = {}
+        self.folded_to_token = {}
+        self.fuzzy_index = BKTree()
+        # words of a general dictionary, which are never taken for typos of a token
+        self.known_words = set()
+        if known_words is not None:
+            self.add_known_words(known_words)
+        self.tier_hits = {"special": 0, "exact": 0, "casefold": 0, "fuzzy": 0, "embedding": 0}
+
+    def add_descriptions(self, token, descriptions):
+        """Make a token resolvable from its own name and any of its descriptions."""
+        for description in [token] + list(descriptions):
+            # the first token to claim a description keeps it, the same way TokenMap resolves synonyms
+            self.description_to_token.setdefault(description, token)
+            self.folded_to_token.setdefault(description.casefold(), token)
+            # words are resolved one at a time, so multi word descriptions can only ever match exactly
+            if " " not in description:
+                self.fuzzy_index.add(description.casefold())
+
+    def remove_descriptions(self, token):
+        """Stop resolving anything to a token."""
+        self.description_to_token = {description: t for description, t in self.description_to_token.items()
+                                     if t != token}
+        self.folded_to_token = {description: t for description, t in self.folded_to_token.items() if t != token}
+
+    def add_known_words(self, words):
+        self.known_words.update(word.casefold() for word in words)
+
+    def count_hit(self, tier):
+        self.tier_hits[tier] += 1
+        Metrics.get_instance().increment(f"resolver.{tier}")
+
+    @staticmethod
+    def get_max_typos(word):
+        # short words are too close to each other to allow any typos
+        if len(word) <= 3:
+            return 0
+        if len(word) <= 6:
+            return 1
+        return 2
+
+    def resolve(self, word):
+        """Return the token for word, or None if the word needs the embedding search."""
+        return self.resolve_with_tier(word)[0]
+
+    def resolve_with_tier(self, word):
+        """Return the token for word and the tier that found it, or (None, None) if it needs the embedding search."""
+        token = self.description_to_token.get(word)
+        if token is not None:
+            self.count_hit("exact")
+            return token, "exact"
+
+        folded_word = word.strip(string.punctuation).casefold()
+        token = self.folded_to_token.get(folded_word)
+        if token is not None:
+            self.count_hit("casefold")
+            return token, "casefold"
+
+        token = self.find_typo_of(folded_word)
+        if token is not None:
+            self.count_hit("fuzzy")
+            return token, "fuzzy"
+
+        return None, None
+
+    def find_typo_of(self, folded_word):
+        """Return the token that folded_word is a clear misspelling of, or None."""
+        max_typos = self.get_max_typos(folded_word)
+        # a real word is never a typo, "kind" is not "find" and "have" is not "save"
+        if max_typos == 0 or folded_word in self.known_words:
+            return None
+
+        matches = self.fuzzy_index.search(folded_word, max_typos)
+        # a BK-tree can not delete words, so the words of removed tokens stay in it and are skipped here
+        tokens = {self.folded_to_token[match] for distance, match in matches if match in self.folded_to_token}
+        # the best token has to be clearly ahead: if any other token is within the allowed typos as well, even if
+        # further away, the word is left to the embedding search
+        if len(tokens) != 1:
+            return None
+        return tokens.pop()
+
+    def get_stats(self):
+        return dict(self.tier_hits)
+
+
+if __name__ == "__main__":
+    # Example usage of the WordResolver
+    word_resolver = WordResolver()
+    word_resolver.add_descriptions("get", ["retrieve", "fetch", "obtain"])
+    word_resolver.add_descriptions("wikipedia", ["wiki", "encyclopedia"])
+    word_resolver.add_descriptions("search", ["look up", "find", "seek"])
+
+    assert word_resolver.resolve("fetch") == "get"
+    assert word_resolver.resolve("Search") == "search"
+    assert word_resolver.resolve("fetchs") == "get"
+    assert word_resolver.resolve("wikipeida") == "wikipedia"
+    assert word_resolver.resolve("puffins") is None
+
+    # the distance is a metric, so the tree finds every match a full scan finds, swaps included
+    words = ["bc", "cb", "abc", "acb", "bca", "ca", "ab"]
+    tree = BKTree()
+    for word in words:
+        tree.add(word)
+    for word in words + ["cab", "b", "cba"]:
+        assert tree.search(word, 1) == sorted((get_edit_distance(word, other), other) for other in words
+                                              if get_edit_distance(word, other) <= 1)
+    assert get_edit_distance("ca", "abc") == 2
+
+    # ordinary words are not taken for typos of the tokens they happen to be close to
+    word_resolver.add_descriptions("save", ["write", "store"])
+    word_resolver.add_descriptions("file", ["document"])
+    word_resolver.add_known_words(["kind", "mind", "have", "same", "gave", "five", "fire", "wind", "week"])
+    for word in ["kind", "mind", "have", "same", "gave", "five", "fire", "wind", "week"]:
+        assert word_resolver.resolve(word) is None, word
+    assert word_resolver.resolve("stoer") == "save"
+
+    word_resolver.remove_descriptions("wikipedia")
+    assert word_resolver.resolve("wiki") is None
+    assert word_resolver.resolve("wikipeida") is None
+    print(word_resolver.get_stats())
@@ -0,0 +1,39 @@
+# defines install_stub_backends, which replaces the network backends of the actions in promethia-actions
+# the benchmarks load the real action modules, so they time the same signatures and code paths a user runs
+
+import sys
+import types
+
+STUB_PAGE = "<html><body><h1>{url}</h1><p>A stub page, served without touching the network.</p></body></html>"
+
+
+class StubDDGS:
+    """Stand-in for duckduckgo_search.DDGS, returning made-up results for any query."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def text(self, query, max_results=5):
+        return [{"title": f"{query} {i}", "href": f"http://localhost/{i}", "body": f"a result about {query}"}
+                for i in range(max_results)]
+
+
+def stub_summary(query, auto_suggest=True):
+    return f"{query} is the subject of a stub summary, served without touching the network."
+
+
+def install_stub_backends():
+    """Install the stubs, before the parser loads the actions that import the backends."""
+    wikipedia = types.ModuleType("wikipedia")
+    wikipedia.summary = stub_summary
+    sys.modules["wikipedia"] = wikipedia
+
+    duckduckgo_search = types.ModuleType("duckduckgo_search")
+    duckduckgo_search.DDGS = StubDDGS
+    sys.modules["duckduckgo_search"] = duckduckgo_search
+
+    from WebCache import WebCache
+    WebCache.get_instance().get_text = lambda url: STUB_PAGE.format(url=url)
@@ -0,0 +1,35 @@
+# defines StubEmbeddingModel, an offline and deterministic stand-in for SentenceTransformer
+# words that share character trigrams get close embeddings, which is enough for the parser and the indexes to work
+
+import hashlib
+
+import numpy as np
+
+
+class StubEmbeddingModel:
+    def __init__(self, dimensions=384):
+        self.dimensions = dimensions
+        self.trigram_cache = {}
+
+    def get_trigram_slot(self, trigram):
+        slot = self.trigram_cache.get(trigram)
+        if slot is None:
+            # md5 rather than hash(), so the embeddings are the same in every process
+            slot = int(hashlib.md5(trigram.encode()).hexdigest()[:8], 16) % self.dimensions
+            self.trigram_cache[trigram] = slot
+        return slot
+
+    def encode_one(self, text):
+        embedding = np.zeros(self.dimensions, dtype=np.float32)
+        padded = f"  {text.lower()} "
+        for i in range(len(padded) - 2):
+            embedding[self.get_trigram_slot(padded[i:i + 3])] += 1.0
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def encode(self, text, **kwargs):
+        if isinstance(text, str):
+            return self.encode_one(text)
+        if len(text) == 0:
+            return np.zeros((0, self.dimensions), dtype=np.float32)
+        return np.stack([self.encode_one(t) for t in text])
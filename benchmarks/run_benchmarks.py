@@ -0,0 +1,509 @@
+# runs the benchmark suite offline, with a stub embedding model and the real actions over stubbed network backends
+# results are written as json, so runs from different commits can be compared with --compare
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+ACTION_PATH = os.path.join(REPO_PATH, "promethia-actions")
+SYNONYMS_FILE = os.path.join(ACTION_PATH, "synonyms.json")
+
+sys.path.insert(0, REPO_PATH)
+sys.path.insert(0, BENCHMARK_PATH)
+
+import TextUtils
+from PromethiaParser import PromethiaParser, greet, add_numbers
+from SemanticMapper import SemanticMapper
+from StubBackends import install_stub_backends
+from StubModels import StubEmbeddingModel
+
+TOPICS = ["golem", "puffins", "ant colonies", "panda bears", "the transformer architecture", "Rachel Alucard",
+          "volcanoes", "the roman empire", "quantum computing", "coral reefs", "jazz history", "black holes"]
+NAMES = ["Alice", "Bob", "Rachel Alucard", "the whole world", "Carol", "Dave"]
+LINE_TEMPLATES = [
+    "search wikipedia for {topic}",
+    "Search wikipedia for '{topic}' and save it to a file named '{file}'",
+    "search the web for '{topic}' and save it to a variable named '{variable}'",
+    "fetch webpage at 'https://en.wikipedia.org/wiki/{page}' and save it to a variable named '{variable}'",
+    "look up {topic} on the encyclopedia",
+    "say hello to {name}",
+    "say hello to {name} and add {a} plus {b}",
+    "I'mma gonna say hello to {name} and add {a} plus {b}",
+    "add {a} plus {b}",
+    "get file named '{file}' and save it to a file named '{file}.bak'",
+    "save {topic} to variable {variable}",
+    "Sure! I will retrieve the page from {topic} now.",
+    "remember '{topic} came up in the notes today' as '{variable}'",
+    "recall from memory what {topic} is",
+    "recall {topic} and save it to a variable named '{variable}'",
+]
+
+
+def make_corpus(num_lines, seed=42):
+    """Generate lines that look like the actions an LLM writes, the same lines for the same seed."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(num_lines):
+        topic = rng.choice(TOPICS)
+        corpus.append(rng.choice(LINE_TEMPLATES).format(
+            topic=topic, name=rng.choice(NAMES), a=rng.randint(0, 99), b=rng.randint(0, 99),
+            file=topic.replace(" ", "_") + ".txt", variable="var_" + topic.split()[0].lower(),
+            page=topic.title().replace(" ", "_")))
+    return corpus
+
+
+def make_text(num_words, seed=42):
+    rng = random.Random(seed)
+    vocabulary = [word for topic in TOPICS for word in topic.lower().split()]
+    vocabulary += ["the", "of", "and", "a", "model", "attention", "layer", "encoder", "decoder", "training"]
+    return " ".join(rng.choice(vocabulary) for _ in range(num_words))
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "count": count,
+        "mean_ms": 1000 * sum(latencies) / count,
+        "p50_ms": 1000 * latencies[count // 2],
+        "p95_ms": 1000 * latencies[min(count - 1, int(count * 0.95))],
+        "max_ms": 1000 * latencies[-1],
+    }
+
+
+def make_files():
+    """Write the files the corpus reads, into the working directory."""
+    for topic in TOPICS:
+        with open(topic.replace(" ", "_") + ".txt", 'w', encoding="utf-8") as f:
+            f.write(make_text(200))
+
+
+def make_parser(model):
+    parser = PromethiaParser(action_path=ACTION_PATH, synonyms_file=SYNONYMS_FILE, embedding_model=model)
+    # the example actions of the parser, which the greeting and adding lines of the corpus use
+    parser.register_action(greet)
+    parser.register_action(add_numbers)
+    return parser
+
+
+def bench_action_registration(model, num_actions):
+    parser = make_parser(model)
+    actions = []
+    for i in range(num_actions):
+        def action(first, second, i=i):
+            return f"{i}: {first} {second}"
+        action.__name__ = f"synthetic_action_{i}"
+        action.__doc__ = f"verb{i} (the) noun{i % 50} (from) <first> into{i % 7} <second>"
+        actions.append(action)
+
+    start = time.perf_counter()
+    for action in actions:
+        parser.register_action(action)
+    elapsed = time.perf_counter() - start
+
+    return {"actions": num_actions, "total_s": elapsed, "per_action_us": 1e6 * elapsed / num_actions}
+
+
+def bench_parse_string(model, num_lines):
+    parser = make_parser(model)
+    corpus = make_corpus(num_lines)
+
+    # warm up on a separate slice of lines, so first-call costs are not counted
+    for line in make_corpus(20, seed=7):
+        parser.parse_string(line)
+
+    latencies = []
+    start = time.perf_counter()
+    for line in corpus:
+        line_start = time.perf_counter()
+        parser.parse_string(line)
+        latencies.append(time.perf_counter() - line_start)
+    elapsed = time.perf_counter() - start
+
+    result = summarize(latencies)
+    result["lines_per_second"] = num_lines / elapsed
+    result["embedding_calls"] = parser.word_resolver.get_stats()["embedding"]
+    return result
+
+
+def bench_bulk_parse(model, num_lines, workers):
+    parser = make_parser(model)
+    corpus = make_corpus(num_lines)
+
+    start = time.perf_counter()
+    for _ in parser.parse_lines(corpus, workers=1, dry_run=True):
+        pass
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in parser.parse_lines(corpus, workers=workers, dry_run=True):
+        pass
+    pooled = time.perf_counter() - start
+
+    return {"lines": num_lines, "workers": workers, "serial_s": serial, "pooled_s": pooled,
+            "serial_lines_per_second": num_lines / serial, "pooled_lines_per_second": num_lines / pooled}
+
+
+def bench_semantic_mapper(model, num_ids):
+    ids_to_descriptions = {f"id{i}": [f"word{i}", f"alias{i}", f"other name {i}"] for i in range(num_ids)}
+
+    start = time.perf_counter()
+    semantic_mapper = SemanticMapper(ids_to_descriptions, embedding_model=model)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(50):
+        semantic_mapper.add_id_and_descriptions(f"new{i}", [f"fresh{i}", f"novel{i}"])
+    add = (time.perf_counter() - start) / 50
+
+    start = time.perf_counter()
+    for i in range(5):
+        semantic_mapper.remove_id(f"new{i}")
+    remove = (time.perf_counter() - start) / 5
+
+    words = [f"word{i}" for i in range(0, num_ids, max(1, num_ids // 200))]
+    start = time.perf_counter()
+    for word in words:
+        semantic_mapper.parse_word(word)
+    parse_word = (time.perf_counter() - start) / len(words)
+
+    return {"ids": num_ids, "build_s": build, "add_ms": 1000 * add, "remove_ms": 1000 * remove,
+            "parse_word_us": 1e6 * parse_word}
+
+
+def bench_text_utils(model, num_words, num_queries):
+    text = make_text(num_words)
+
+    start = time.perf_counter()
+    pages = TextUtils.getListOfOverlappedPages(text)
+    chunk = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings = TextUtils.convertStringListToEmbeddings(pages, model)
+    index = TextUtils.getIndexFromListOfEmbeddings(embeddings)
+    embed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    inverted_index = TextUtils.getInvertedIndexFromListOfPages(pages)
+    invert = time.perf_counter() - start
+
+    queries = make_corpus(num_queries, seed=3)
+    start = time.perf_counter()
+    for query in queries:
+        TextUtils.getMostSimilarPages(index, model.encode(query))
+    single_search = (time.perf_counter() - start) / num_queries
+
+    start = time.perf_counter()
+    TextUtils.getMostSimilarPagesForQueries(index, queries, model)
+    batch_search = (time.perf_counter() - start) / num_queries
+
+    start = time.perf_counter()
+    TextUtils.getHybridSimilarPagesForQueries(index, inverted_index, queries, model)
+    hybrid_search = (time.perf_counter() - start) / num_queries
+
+    start = time.perf_counter()
+    for topic in TOPICS:
+        TextUtils.doKeywordLookup(inverted_index, topic)
+    keyword = (time.perf_counter() - start) / len(TOPICS)
+
+    return {"characters": len(text), "pages": len(pages), "chunk_ms": 1000 * chunk, "embed_index_s": embed,
+            "inverted_index_ms": 1000 * invert, "search_us": 1e6 * single_search,
+            "batch_search_us": 1e6 * batch_search, "hybrid_search_us": 1e6 * hybrid_search,
+            "keyword_lookup_us": 1e6 * keyword}
+
+
+def make_document(num_pages, seed=42):
+    """Generate a document that reads like extracted PDF text, with a header and footer on every page."""
+    pages = []
+    for page_number in range(num_pages):
+        body = make_text(300, seed=seed + page_number).capitalize().replace(" the ", ". The ")
+        pages.append(f"Journal of Synthetic Studies, Vol. 3\n{body}.\nPreprint. Do not distribute.\n")
+    # the reference list is repeated at the end, as in some extracted PDFs
+    references = "".join(f"[{i}] A. Author. On {topic}. In Proceedings, {2000 + i}.\n" for i, topic in enumerate(TOPICS))
+    return "".join(pages) + references * 3
+
+
+def bench_chunking(model, num_pages):
+    text = make_document(num_pages)
+
+    start = time.perf_counter()
+    pages = TextUtils.getListOfOverlappedPages(text)
+    fixed = time.perf_counter() - start
+
+    # warm up on a small document, so numpy's first-call costs are not counted
+    TextUtils.getListOfChunks(make_document(2, seed=7))
+    start = time.perf_counter()
+    chunks = TextUtils.getListOfChunks(text)
+    snapped = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embeddings, stats = TextUtils.convertChunksToEmbeddings(chunks, model)
+    embed = time.perf_counter() - start
+
+    # an edited version of the document only embeds the chunks that changed
+    known_embeddings = {TextUtils.getChunkHash(chunk): embedding for chunk, embedding in zip(chunks, embeddings)}
+    edited_chunks = TextUtils.getListOfChunks(text + "Appendix. A note added to the end of the document.\n")
+    start = time.perf_counter()
+    _, edited_stats = TextUtils.convertChunksToEmbeddings(edited_chunks, model, known_embeddings)
+    edited_embed = time.perf_counter() - start
+
+    return {"characters": len(text), "pages": len(pages), "chunks": stats["chunks"],
+            "unique_chunks": stats["unique_chunks"], "deduplication_ratio": stats["deduplication_ratio"],
+            "embedding_calls_saved": stats["embedding_calls_saved"],
+            "edited_embedded_chunks": edited_stats["embedded_chunks"], "fixed_pages_ms": 1000 * fixed,
+            "chunk_ms": 1000 * snapped, "embed_ms": 1000 * embed, "edited_embed_ms": 1000 * edited_embed}
+
+
+def bench_cold_start():
+    """Time a fresh process importing the parser and building it, in a temporary working directory."""
+    script = f"""
+import sys, time
+start = time.perf_counter()
+sys.path[:0] = [{REPO_PATH!r}, {BENCHMARK_PATH!r}]
+from PromethiaParser import PromethiaParser
+from StubBackends import install_stub_backends
+from StubModels import StubEmbeddingModel
+install_stub_backends()
+imported = time.perf_counter()
+PromethiaParser(action_path={ACTION_PATH!r}, synonyms_file={SYNONYMS_FILE!r},
+                embedding_model=StubEmbeddingModel())
+print(imported - start, time.perf_counter() - imported)
+"""
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", script], cwd=directory, capture_output=True, text=True,
+                                check=True).stdout
+        total = time.perf_counter() - start
+    import_time, construct_time = (float(value) for value in output.split()[-2:])
+    return {"process_s": total, "import_s": import_time, "construct_s": construct_time}
+
+
+RELOADED_ACTION = '''
+def {name}_{i}(text):
+    """{name}{i} {adverb} <text>"""
+    return text
+'''
+
+
+def bench_action_reload(model, num_reloads):
+    """Time picking up an added, an edited and a deleted action file, against building a new parser."""
+    with tempfile.TemporaryDirectory() as action_path:
+        for file in os.listdir(ACTION_PATH):
+            if file.endswith(".py"):
+                shutil.copy(os.path.join(ACTION_PATH, file), action_path)
+        start = time.perf_counter()
+        parser = PromethiaParser(action_path=action_path, synonyms_file=SYNONYMS_FILE, embedding_model=model)
+        construct = time.perf_counter() - start
+
+        action_file = os.path.join(action_path, "ReloadedActions.py")
+        latencies = {"unchanged": [], "add": [], "edit": [], "delete": []}
+        for i in range(num_reloads):
+            for step, name in (("add", "shout"), ("edit", "whisper"), ("delete", None)):
+                if name is None:
+                    os.remove(action_file)
+                else:
+                    with open(action_file, 'w', encoding="utf-8") as f:
+                        f.write(RELOADED_ACTION.format(name=name, i=i, adverb="loudly"))
+                start = time.perf_counter()
+                parser.reload_actions()
+                latencies[step].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            parser.reload_actions()
+            latencies["unchanged"].append(time.perf_counter() - start)
+
+    result = {"construct_s": construct}
+    for step, step_latencies in latencies.items():
+        result[f"{step}_ms"] = 1000 * sum(step_latencies) / num_reloads
+    return result
+
+
+WORKER_MEMORY_SCRIPT = """
+import sys
+sys.path[:0] = [{repo_path!r}, {benchmark_path!r}]
+import numpy as np
+{setup}
+print("ready", flush=True)
+sys.stdin.readline()
+memory = {{}}
+with open("/proc/self/smaps_rollup", 'r') as f:
+    for line in f:
+        name, _, value = line.partition(":")
+        if value.strip().endswith("kB"):
+            memory[name] = int(value.split()[0])
+print(memory["Rss"], memory["Pss"], memory["Private_Clean"] + memory["Private_Dirty"], flush=True)
+"""
+# what each worker holds when its memory is measured: a cached index, read or mapped, or a semantic mapper, built from
+# the vocabulary or mapped from the files of a mapper that another process built
+INDEX_SETUP = """
+import TextUtils
+index = TextUtils.readIndex({index_file!r}, use_mmap={use_mmap!r})
+index.search(np.zeros((1, index.d), dtype=np.float32), 1)
+"""
+SEMANTIC_BUILD_SETUP = """
+import json
+from SemanticMapper import SemanticMapper
+from StubModels import StubEmbeddingModel
+with open({vocabulary_file!r}, 'r', encoding="utf-8") as f:
+    semantic_mapper = SemanticMapper(json.load(f), embedding_model=StubEmbeddingModel())
+semantic_mapper.parse_words(["word"])
+"""
+SEMANTIC_SHARED_SETUP = """
+from SemanticMapper import SemanticMapper
+from StubModels import StubEmbeddingModel
+semantic_mapper = SemanticMapper.load_shared({prefix!r}, embedding_model=StubEmbeddingModel())
+semantic_mapper.parse_words(["word"])
+"""
+
+
+def measure_worker_memory(setup, num_workers):
+    """Return the mean Rss, Pss and private memory in MB of workers that each run setup, all alive at once."""
+    script = WORKER_MEMORY_SCRIPT.format(repo_path=REPO_PATH, benchmark_path=BENCHMARK_PATH, setup=setup)
+    workers = [subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True) for _ in range(num_workers)]
+    try:
+        # memory is only read once every worker is set up, so shared pages are split between all of them
+        for worker in workers:
+            if worker.stdout.readline().strip() != "ready":
+                raise RuntimeError("a worker failed to set up")
+        for worker in workers:
+            worker.stdin.write("\n")
+            worker.stdin.flush()
+        reports = [[int(value) for value in worker.stdout.readline().split()] for worker in workers]
+    finally:
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+    return [sum(report[i] for report in reports) / (1024 * num_workers) for i in range(3)]
+
+
+def bench_worker_memory(model, num_vectors, num_workers, dimensions=384):
+    """
+    Compare the memory of workers that read a cached index into private memory with workers that map it, and of
+    workers that build a semantic mapper with workers that map one shared with load_shared.
+    """
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        return {"skipped": "needs /proc/self/smaps_rollup"}
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.random((num_vectors, dimensions), dtype=np.float32)
+    TextUtils.getIndexFromListOfEmbeddings(embeddings, "worker_memory.faiss")
+
+    # a vocabulary with as many descriptions as the index has vectors, five to an id
+    vocabulary = {f"id{i}": [f"description {i} {j}" for j in range(4)] for i in range(num_vectors // 5)}
+    with open("worker_memory.json", 'w', encoding="utf-8") as f:
+        json.dump(vocabulary, f)
+    prefix = SemanticMapper(vocabulary, embedding_model=model).save_shared()
+
+    result = {"vectors": num_vectors, "workers": num_workers,
+              "index_mb": os.path.getsize("worker_memory.faiss") / (1024 * 1024)}
+    setups = {
+        "read": INDEX_SETUP.format(index_file=os.path.abspath("worker_memory.faiss"), use_mmap=False),
+        "mmap": INDEX_SETUP.format(index_file=os.path.abspath("worker_memory.faiss"), use_mmap=True),
+        "semantic_build": SEMANTIC_BUILD_SETUP.format(vocabulary_file=os.path.abspath("worker_memory.json")),
+        "semantic_shared": SEMANTIC_SHARED_SETUP.format(prefix=prefix),
+    }
+    try:
+        for name, setup in setups.items():
+            rss, pss, private = measure_worker_memory(setup, num_workers)
+            result[f"{name}_rss_mb"] = rss
+            result[f"{name}_pss_mb"] = pss
+            result[f"{name}_private_mb"] = private
+    finally:
+        SemanticMapper.remove_shared(prefix)
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, tolerance):
+    """Print the timings that got slower than the baseline by more than tolerance, return how many did."""
+    with open(baseline_file, 'r', encoding="utf-8") as f:
+        baseline = json.load(f)["benchmarks"]
+
+    regressions = 0
+    for name, metrics in results["benchmarks"].items():
+        for metric, value in metrics.items():
+            old_value = baseline.get(name, {}).get(metric)
+            # only timings are compared, throughput is derived from them
+            if not metric.endswith(("_s", "_ms", "_us")) or not old_value:
+                continue
+            ratio = value / old_value
+            if ratio > 1 + tolerance:
+                regressions += 1
+                print(f"REGRESSION {name}.{metric}: {old_value:.4g} -> {value:.4g} ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Run the Promethia benchmarks offline.")
+    arg_parser.add_argument("--output", help="write the results to this json file instead of stdout")
+    arg_parser.add_argument("--compare", help="json results of an earlier run to check for regressions")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="how much slower than the baseline counts as a regression (default 0.2)")
+    arg_parser.add_argument("--quick", action="store_true", help="smaller sizes, for a fast smoke run")
+    arg_parser.add_argument("--only", nargs="*", help="names of the benchmarks to run")
+    args = arg_parser.parse_args()
+
+    scale = 0.1 if args.quick else 1.0
+    model = StubEmbeddingModel()
+
+    benchmarks = {
+        "action_registration": lambda: bench_action_registration(model, int(2000 * scale)),
+        "parse_string": lambda: bench_parse_string(model, int(5000 * scale)),
+        "bulk_parse": lambda: bench_bulk_parse(model, int(20000 * scale), os.cpu_count() or 1),
+        "semantic_mapper": lambda: bench_semantic_mapper(model, int(2000 * scale)),
+        "text_utils": lambda: bench_text_utils(model, int(200000 * scale), int(200 * scale)),
+        "chunking": lambda: bench_chunking(model, int(500 * scale)),
+        "cold_start": bench_cold_start,
+        "action_reload": lambda: bench_action_reload(model, max(1, int(50 * scale))),
+        "worker_memory": lambda: bench_worker_memory(model, int(100000 * scale), 4),
+    }
+
+    # the parser writes variables and files relative to the working directory, so keep them out of the repo
+    working_directory = os.getcwd()
+    results = {"commit": get_commit(), "python": platform.python_version(), "platform": platform.platform(),
+               "timestamp": time.time(), "quick": args.quick, "benchmarks": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            install_stub_backends()
+            make_files()
+            for name, benchmark in benchmarks.items():
+                if args.only and name not in args.only:
+                    continue
+                print(f"Running {name}...", file=sys.stderr)
+                results["benchmarks"][name] = benchmark()
+        finally:
+            os.chdir(working_directory)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare and compare(results, args.compare, args.tolerance) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
-import html2text
-import requests
+import logging
+
 from VariableMap import VariableMap
+from WebCache import WebCache
+from FileValue import FileValue
+
+logger = logging.getLogger(__name__)
 
 def store_variable_1(data, name):
     """save <data> to variable (named) <name>"""
     VariableMap.get_instance().set_data(name, data)
-    print(f"Storing in variable {name}")
+    logger.debug("Storing in variable %s", name)
     return data
 
 def get_variable_0(name):
@@ -14,22 +18,17 @@ def get_variable_0(name):
 
 def store_file_1(data, name):
     """save <data> (to) file (named) <name>"""
-    with open(name, 'w', encoding="utf-8") as f:
-        f.write(data)
+    # file values and iterators are streamed to the file rather than held in memory
+    FileValue.write_to_file(data, name)
     return data
 
 def get_file_0(name):
     """get (from) file (named) <name>"""
-    with open(name, 'r', encoding="utf-8") as f:
-        return f.read()
+    # the contents are only read when something needs them as text
+    return FileValue(name)
 
 def webpage_0(url):
     """fetch webpage (from) <url>"""
-    response = requests.get(url)
-    html_content = response.text
-
-    h = html2text.HTML2Text()
-    h.ignore_links = False
-    text = h.handle(html_content)
-    return text
+    html_content = WebCache.get_instance().get_text(str(url))
+    return WebCache.html_to_text(html_content)
 
@@ -0,0 +1,11 @@
+from MemoryMap import MemoryMap
+
+def recall_memory_0(query):
+    """recall (from) (memory) <query>"""
+    pages = MemoryMap.get_instance().recall(query)
+    return "\n\n".join(f"[{name}] {page}" for name, page in pages)
+
+def remember_data_1(data, name):
+    """remember <data> as <name>"""
+    MemoryMap.get_instance().remember(name, str(data))
+    return data
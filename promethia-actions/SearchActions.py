@@ -1,17 +1,35 @@
+import logging
+
 from duckduckgo_search import DDGS
 import wikipedia
+from ResultCache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+# results are shared by every parser in the process, and kept on disk for later runs
+wikipedia_cache = ResultCache.get_cache("wikipedia", ttl=24 * 3600,
+                                        persist_path="./.promethia-cache/results/wikipedia.json")
+duckduckgo_cache = ResultCache.get_cache("duckduckgo", ttl=3600,
+                                         persist_path="./.promethia-cache/results/duckduckgo.json")
 
 def search_wikipedia_0(query):
     """search wikipedia for <query>"""
-    output = wikipedia.summary(query, auto_suggest=False)
+    query = str(query)
+    # wikipedia titles are case sensitive after the first letter ("Red Dwarf" is not "Red dwarf")
+    key = ResultCache.make_key(query, casefold=False, auto_suggest=False)
+    output = wikipedia_cache.get_or_compute(key, lambda: wikipedia.summary(query, auto_suggest=False))
     return output
 
 
 def duckduckgo_search_0(query, max_results=5):
     """search web for <query>"""
-    # add quotes to the query to search for the exact phrase
-    query = f'"{query}"'
-    with DDGS() as ddgs:
-        results = [result for result in ddgs.text(query, max_results=max_results)]
-    print(results)
-    return str(results)
\ No newline at end of file
+    query = str(query)
+
+    def search():
+        # add quotes to the query to search for the exact phrase
+        with DDGS() as ddgs:
+            results = [result for result in ddgs.text(f'"{query}"', max_results=max_results)]
+        logger.debug("DuckDuckGo results: %s", results)
+        return str(results)
+
+    return duckduckgo_cache.get_or_compute(ResultCache.make_key(query, max_results=max_results), search)
\ No newline at end of file